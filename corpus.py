@@ -0,0 +1,396 @@
+import threading
+import time
+import logging
+import pandas as pd
+import streamlit as st
+import db_utils
+from helpers import parse_csv_text_to_json, convert_yaml_text_to_json, extract_url, normalize_api_query
+from settings import get_setting
+from local_snapshot import get_local_snapshot_store, OFFLINE_MODE
+
+logger = logging.getLogger(__name__)
+
+CORPUS_TTL = get_setting("CORPUS_TTL", 60.0)
+CORPUS_FULL_REFRESH_SECONDS = get_setting("CORPUS_FULL_REFRESH_SECONDS", 3600.0)
+
+RAW_OUTPUT_COLUMNS = ["ner_output", "search_list_chain_output", "final_output"]
+
+# Columns the corpus loads select. The raw outputs are still needed to derive the
+# comparison fields; they are dropped from the frame once parsed.
+CORPUS_SELECT = ", ".join(f"`{col}`" for col in ["id", "row_id", "alt_id", "user_query", "query_type", "time_stamp", *RAW_OUTPUT_COLUMNS])
+
+DERIVED_COLUMNS = [
+    "has_ner", "needs_fill", "is_new_row",
+    "ner_intent", "ner_search_fields", "ner_leaf_entities", "ner_date_filter", "has_date_filter",
+    "chain_field_values", "final_url", "parse_error",
+]
+
+RECORD_COLUMNS = [
+    "id", "row_id", "alt_id", "user_query", "has_ner", "needs_fill", "is_new_row",
+    "ner_intent", "ner_search_fields", "ner_leaf_entities", "ner_date_filter", "has_date_filter",
+    "chain_field_values", "final_url", "parse_error",
+]
+
+_UNPARSEABLE = object()
+
+def _is_blank(value):
+    return value is None or (isinstance(value, float) and pd.isna(value)) or value == ""
+
+def derive_ner_fields(ner_output):
+    """Returns (parsed, intent, search_fields, leaf_entities, date_filter) for a stored ner_output."""
+    ner = parse_csv_text_to_json(ner_output)
+    intent, search_fields, leaf_entities, date_filter = "", "", "", ""
+    if ner and isinstance(ner, dict):
+        intent = ner.get("intent", "")
+        search_fields = ner.get("search_fields", "")
+        leaf_entities = ner.get("leaf_entities", "")
+        if search_fields:
+            date_filter = [field.get("date_filter", "").get("value", "") for field in search_fields if isinstance(field, dict)]
+            search_fields = [field for field in search_fields if not isinstance(field, dict)]
+    return ner, intent, search_fields, leaf_entities, date_filter
+
+def derive_search_fields(search_output):
+    """Returns (parsed, chain_field_values) for a stored search_list_chain_output."""
+    search = convert_yaml_text_to_json(search_output)
+    chain_field_values = ""
+    if search:
+        chain_search_fields = search.get("search_fields", "")
+        chain_field_values = [item.get("field_value", "") for item in chain_search_fields if item.get("field_type", "") != "date"]
+    return search, chain_field_values
+
+def derive_final_url(final_output):
+    if isinstance(final_output, dict):
+        return final_output['url']
+    if final_output:
+        return extract_url(final_output)
+    return ""
+
+def _map_unique(series, derive, ids):
+    """
+    Applies derive() once per distinct value of the column and broadcasts the
+    result. A value derive() fails on is logged with the id of a row holding it
+    and maps to _UNPARSEABLE, so one malformed row cannot fail the whole load.
+    """
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    derived = []
+    for code, value in enumerate(uniques):
+        try:
+            derived.append(derive(value))
+        except Exception:
+            logger.exception(f"Could not parse {series.name} of test_results row {ids[codes == code][0]}, comparing it as empty.")
+            derived.append(_UNPARSEABLE)
+    missing = derive(None)
+    return [derived[code] if code >= 0 else missing for code in codes]
+
+def preprocess_corpus(df):
+    """
+    One-time pass over the test_results frame that adds typed comparison columns:
+    NER intent, search fields, leaf entities and date filters, chain field values
+    and the canonical final URL. Each distinct raw value is parsed once, so the
+    cost scales with the corpus rather than with alternatives x reruns.
+    Outputs that cannot be parsed get empty derived fields, and their column
+    names are listed in parse_error so the comparison reports the row as failed.
+    The heavy raw output columns are dropped from the result; fetch_old_outputs
+    loads them on demand for the rows that need to be displayed.
+    """
+    ids = df['id'].to_numpy()
+    ner = _map_unique(df['ner_output'], derive_ner_fields, ids)
+    search = _map_unique(df['search_list_chain_output'], derive_search_fields, ids)
+    final_urls = _map_unique(df['final_output'], derive_final_url, ids)
+    parse_error = [
+        ", ".join(col for col, value in zip(RAW_OUTPUT_COLUMNS, values) if value is _UNPARSEABLE)
+        for values in zip(ner, search, final_urls)
+    ]
+    ner = [derive_ner_fields(None) if value is _UNPARSEABLE else value for value in ner]
+    search = [derive_search_fields(None) if value is _UNPARSEABLE else value for value in search]
+    final_urls = ["" if url is _UNPARSEABLE else url for url in final_urls]
+
+    blank = df[RAW_OUTPUT_COLUMNS].map(_is_blank)
+    ner_text = df['ner_output'].astype(str).str.strip()
+
+    return df.assign(
+        has_ner=df['ner_output'].notna(),
+        needs_fill=df['ner_output'].isna() | (ner_text == "") | (ner_text == "{}"),
+        is_new_row=blank.all(axis=1),
+        ner_intent=[n[1] for n in ner],
+        ner_search_fields=[n[2] for n in ner],
+        ner_leaf_entities=[n[3] for n in ner],
+        ner_date_filter=[n[4] for n in ner],
+        has_date_filter=[bool(n[4]) for n in ner],
+        chain_field_values=[s[1] for s in search],
+        final_url=final_urls,
+        parse_error=parse_error,
+    ).drop(columns=RAW_OUTPUT_COLUMNS)
+
+def merge_filled_rows(df, fills):
+    """
+    Applies {id: updates} from the fill phase to a preprocessed frame, or to a
+    frame of group records, without reloading anything. Only the filled rows are
+    preprocessed again, from the raw outputs carried in their updates.
+    """
+    mask = df['id'].isin(list(fills))
+    if not mask.any():
+        return df
+    updated = preprocess_corpus(_filled_raw_rows(df, fills))
+    for col in updated.columns.intersection(df.columns):
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            updated[col] = pd.to_datetime(updated[col], errors='coerce')
+    return pd.concat([df[~mask], updated[df.columns]]).reindex(df.index)
+
+def _filled_raw_rows(df, fills):
+    """The rows of `df` named in `fills` as raw test_results rows, with the fill updates applied."""
+    rows = df[df['id'].isin(list(fills))].drop(columns=[col for col in DERIVED_COLUMNS if col in df.columns])
+    for col in next(iter(fills.values())):
+        rows[col] = [fills[r_id][col] for r_id in rows['id']]
+    return rows
+
+def fetch_old_outputs(ids):
+    """
+    Fetches and parses the stored NER and search outputs for the given ids in a
+    single query. Returns {id: {"old_ner": ..., "old_search": ...}}.
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    id_placeholders = ", ".join([f":id_{i}" for i in range(len(ids))])
+    query = f"SELECT id, ner_output, search_list_chain_output FROM test_results WHERE id IN ({id_placeholders})"
+    df = db_utils.fetch_dataframe("llm", query, params={f"id_{i}": r_id for i, r_id in enumerate(ids)})
+    if df is None:
+        return {}
+    return {
+        row['id']: {
+            "old_ner": parse_csv_text_to_json(row['ner_output']),
+            "old_search": convert_yaml_text_to_json(row['search_list_chain_output']),
+        }
+        for row in df.to_dict('records')
+    }
+
+def build_group_records(df):
+    """
+    Turns a preprocessed frame into {row_id: [record, ...]}, where each record is a
+    compact dict of the pre-parsed fields the workers compare against.
+    """
+    groups = {}
+    for record in df[RECORD_COLUMNS].to_dict('records'):
+        groups.setdefault(record['row_id'], []).append(record)
+    return dict(sorted(groups.items()))
+
+NO_INTENT = "(none)"
+PENDING_FILL_INTENT = "(needs fill)"
+
+def intent_key(ner_intent):
+    """Label of a parsed NER intent, used as the GroupIndex key."""
+    if isinstance(ner_intent, list):
+        return ", ".join(str(intent) for intent in ner_intent) or NO_INTENT
+    return str(ner_intent) if ner_intent else NO_INTENT
+
+class GroupIndex:
+    """
+    row_ids of the loaded groups by the NER intent and query type of their first
+    row, which is the row a run decides on. Groups whose first row still needs a
+    fill have no intent yet and are indexed under PENDING_FILL_INTENT.
+    """
+
+    def __init__(self, group_records):
+        self.by_intent = {}
+        self.by_query_type = {}
+        for row_id, records in group_records.items():
+            base_row = records[0]
+            intent = PENDING_FILL_INTENT if base_row['needs_fill'] else intent_key(base_row['ner_intent'])
+            self.by_intent.setdefault(intent, set()).add(row_id)
+            self.by_query_type.setdefault(normalize_api_query(base_row['user_query'])[1], set()).add(row_id)
+
+    def _union(self, index, keys):
+        return set().union(*(index.get(key, set()) for key in keys))
+
+    def select(self, intents=None, query_types=None, depth_mode=False):
+        """
+        Returns the row_ids matching any of `intents` and any of `query_types`; an
+        empty filter matches everything. Depth mode only keeps search_list groups,
+        plus the groups whose intent is only known after their fill.
+        """
+        selected = self._union(self.by_intent, self.by_intent)
+        if intents:
+            selected &= self._union(self.by_intent, intents)
+        if query_types:
+            selected &= self._union(self.by_query_type, query_types)
+        if depth_mode:
+            selected &= self._union(self.by_intent, [intent_key(["search_list"]), PENDING_FILL_INTENT])
+        return selected
+
+def get_group_records(df):
+    """Returns (group_records, GroupIndex) for a corpus frame, built once per frame and session."""
+    cached = st.session_state.get('group_records_cache')
+    if cached is None or cached[0] is not df:
+        group_records = build_group_records(df)
+        cached = st.session_state.group_records_cache = (df, group_records, GroupIndex(group_records))
+    return cached[1], cached[2]
+
+class CorpusSnapshot:
+    """
+    Cached, preprocessed copy of test_results shared across Streamlit reruns.
+    Within CORPUS_TTL the cached frame is returned without touching the database.
+    After that a delta refresh lists the live ids, which tells it which rows were
+    added or deleted, and fetches only rows that are new, changed (time_stamp after
+    the last seen one) or explicitly invalidated. A full reload happens every
+    CORPUS_FULL_REFRESH_SECONDS or after invalidate_all(). After our own writes
+    (invalidate() or mark_own_write()) the next load always refreshes before it
+    returns, even within CORPUS_TTL, so a new run sees its own inserts and deletes.
+
+    With a LocalSnapshotStore the first load comes from the local file and the
+    delta refreshes run in a background thread, writing back to the store. In
+    OFFLINE_MODE the database is the store's own test_results table, so only the
+    parsed corpus is written back.
+    """
+
+    def __init__(self, ttl=CORPUS_TTL, full_refresh_seconds=CORPUS_FULL_REFRESH_SECONDS, store=None):
+        self.ttl = ttl
+        self.full_refresh_seconds = full_refresh_seconds
+        self.store = store
+        self.df = None
+        self.loaded_at = 0
+        self.refreshed_at = 0
+        self.last_refresh = None
+        self._dirty_ids = set()
+        self._own_write = False
+        self._lock = threading.Lock()
+        self._sync_thread = None
+
+    def invalidate(self, ids):
+        """Marks rows we changed ourselves so the next load re-fetches them."""
+        with self._lock:
+            self._dirty_ids.update(ids)
+            self._own_write = True
+
+    def mark_own_write(self):
+        """Records that we inserted or deleted rows, so the next load lists the live ids first."""
+        with self._lock:
+            self._own_write = True
+
+    def invalidate_all(self):
+        self.loaded_at = 0
+
+    def apply_fills(self, fills):
+        """
+        Merges the rows a run filled into the cached frame and the local store, so
+        the next load neither re-fetches nor re-fills them.
+        """
+        if not fills:
+            return
+        with self._lock:
+            if self.df is None:
+                return
+            raw_rows = _filled_raw_rows(self.df, fills)
+            self.df = merge_filled_rows(self.df, fills)
+            self._dirty_ids.difference_update(fills)
+            if self.store is not None:
+                if not OFFLINE_MODE:
+                    self.store.upsert_raw(raw_rows)
+                self.store.save_corpus(self.df)
+
+    def is_syncing(self):
+        return self._sync_thread is not None and self._sync_thread.is_alive()
+
+    def load(self, force_refresh=False):
+        """Returns the preprocessed corpus frame, or None if it could not be loaded."""
+        if not force_refresh and not self._own_write and self.df is not None and self.is_syncing():
+            return self.df
+
+        with self._lock:
+            now = time.time()
+            if self.df is None and self.store is not None:
+                self._load_local(now)
+            if self.df is None or now - self.loaded_at > self.full_refresh_seconds:
+                return self._full_load(now)
+            if not (force_refresh or self._own_write or self._dirty_ids or now - self.refreshed_at > self.ttl):
+                return self.df
+            if force_refresh or self._own_write or self.store is None:
+                return self._delta_refresh(now)
+
+        self._start_background_sync()
+        return self.df
+
+    def _load_local(self, now):
+        df = self.store.load_corpus()
+        # A snapshot saved before a derived column was added is reloaded from the database.
+        if df is None or not set(DERIVED_COLUMNS) <= set(df.columns):
+            return
+        self.df = df
+        self.loaded_at = now
+        self.refreshed_at = 0
+        self.last_refresh = {"kind": "local", "rows": len(df), "synced_at": self.store.synced_at()}
+
+    def _start_background_sync(self):
+        with self._lock:
+            if self.is_syncing():
+                return
+            self._sync_thread = threading.Thread(target=self._background_sync, name="corpus-sync", daemon=True)
+            self._sync_thread.start()
+
+    def _background_sync(self):
+        with self._lock:
+            self._delta_refresh(time.time())
+
+    def _full_load(self, now):
+        own_write, self._own_write = self._own_write, False
+        df = db_utils.fetch_dataframe("llm", f"SELECT {CORPUS_SELECT} FROM test_results")
+        if df is None:
+            self._own_write = own_write
+            return self.df
+        self.df = preprocess_corpus(df)
+        self.loaded_at = self.refreshed_at = now
+        self._dirty_ids.clear()
+        self.last_refresh = {"kind": "full", "rows": len(df)}
+        if self.store is not None:
+            if not OFFLINE_MODE:
+                self.store.replace_raw(df)
+            self.store.save_corpus(self.df)
+        return self.df
+
+    def _delta_refresh(self, now):
+        # Cleared before listing ids, so a write made during the refresh still triggers the next one.
+        own_write, self._own_write = self._own_write, False
+        live_ids = db_utils.fetch_dataframe("llm", "SELECT id FROM test_results")
+        if live_ids is None:
+            logger.error("Delta refresh of the corpus failed, keeping the cached snapshot.")
+            self._own_write = own_write
+            return self.df
+
+        live = set(live_ids['id'])
+        fetch_ids = sorted((live - set(self.df['id'])) | (self._dirty_ids & live), key=str)
+        clauses, params = [], {}
+        if fetch_ids:
+            id_placeholders = ", ".join([f":id_{i}" for i in range(len(fetch_ids))])
+            clauses.append(f"`id` IN ({id_placeholders})")
+            params.update({f"id_{i}": r_id for i, r_id in enumerate(fetch_ids)})
+        max_time_stamp = self.df['time_stamp'].dropna().max() if 'time_stamp' in self.df and not self.df.empty else None
+        if max_time_stamp is not None and not pd.isna(max_time_stamp):
+            clauses.append("`time_stamp` > :max_time_stamp")
+            params["max_time_stamp"] = str(max_time_stamp)
+        dirty_ids = set(self._dirty_ids)
+
+        changed = None
+        if clauses:
+            changed = db_utils.fetch_dataframe("llm", f"SELECT {CORPUS_SELECT} FROM test_results WHERE {' OR '.join(clauses)}", params=params)
+            if changed is None:
+                logger.error("Delta refresh of the corpus failed, keeping the cached snapshot.")
+                self._own_write = own_write
+                return self.df
+        changed_ids = set(changed['id']) if changed is not None else set()
+
+        removed_ids = [r_id for r_id in self.df['id'] if r_id not in live]
+        kept = self.df[self.df['id'].isin(live) & ~self.df['id'].isin(changed_ids)]
+        merged = pd.concat([kept, preprocess_corpus(changed)], ignore_index=True) if changed_ids else kept
+        self.df = merged.sort_values('id', kind='stable').reset_index(drop=True)
+        self.refreshed_at = now
+        self._dirty_ids.difference_update(dirty_ids)
+        self.last_refresh = {"kind": "delta", "rows": len(changed_ids), "removed": len(removed_ids)}
+        if self.store is not None and (changed_ids or removed_ids):
+            if not OFFLINE_MODE:
+                self.store.upsert_raw(changed if changed is not None else pd.DataFrame(columns=['id']), removed_ids)
+            self.store.save_corpus(self.df)
+        return self.df
+
+@st.cache_resource
+def get_corpus_snapshot():
+    return CorpusSnapshot(store=get_local_snapshot_store())
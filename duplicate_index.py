@@ -0,0 +1,55 @@
+import threading
+
+class DuplicateQueryIndex:
+    """
+    In-memory index over the loaded test_results rows: user_query -> live row_ids,
+    and user_query -> ids that already have a NER ground truth. It replaces the
+    per-group duplicate SELECTs and is kept in step with the deletes and fills made
+    during the run. A match deletes rows, so queries are keyed exactly as stored,
+    never more loosely than the SELECTs' `user_query = :user_query`.
+    """
+
+    def __init__(self):
+        self._row_ids = {}
+        self._truth_ids = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Builds the index from a preprocessed corpus frame."""
+        index = cls()
+        for record in df[['id', 'row_id', 'user_query', 'has_ner']].to_dict('records'):
+            key = record['user_query']
+            index._row_ids.setdefault(key, set()).add(record['row_id'])
+            if record['has_ner']:
+                index._truth_ids.setdefault(key, set()).add(record['id'])
+        return index
+
+    def claim(self, row_id, user_query, ids=()):
+        """
+        Checks whether another live group has the same query. If so, this group is
+        dropped from the index (together with its ground-truth ids) and the row_id of
+        the surviving group is returned; otherwise returns None. Running the check
+        and the removal under one lock means exactly one of a set of duplicates survives.
+        """
+        with self._lock:
+            row_ids = self._row_ids.get(user_query, set())
+            others = row_ids - {row_id}
+            if not others:
+                return None
+            row_ids.discard(row_id)
+            self._truth_ids.get(user_query, set()).difference_update(ids)
+            return min(others, key=str)
+
+    def has_ground_truth(self, user_query):
+        with self._lock:
+            return bool(self._truth_ids.get(user_query))
+
+    def mark_ground_truth(self, user_query, record_id):
+        """Records that a row now has a stored NER output."""
+        with self._lock:
+            self._truth_ids.setdefault(user_query, set()).add(record_id)
+
+    def stats(self):
+        with self._lock:
+            return {"queries": len(self._row_ids), "groups": sum(len(v) for v in self._row_ids.values())}
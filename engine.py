@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import logging
+from settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = get_setting("MAX_CONCURRENCY", 100)
+
+class AsyncEngine:
+    """
+    Runs an asyncio event loop on a background thread so the synchronous
+    Streamlit script can submit coroutines and collect them with as_completed().
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """Schedules a coroutine on the engine loop and returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """Runs a coroutine on the engine loop and blocks until it finishes."""
+        return self.submit(coro).result()
+
+    def cancel(self, futures):
+        """
+        Cancels every future that has not finished. The cancellation reaches the
+        task on the loop, which aborts open sockets and SSE reads, and queued tasks
+        never start. Returns how many futures were cancelled.
+        """
+        return sum(1 for future in futures if future.cancel())
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Returns the process-wide AsyncEngine, starting it on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            logger.info("Starting async execution engine...")
+            _engine = AsyncEngine()
+        return _engine
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import logging
+from types import MappingProxyType
+import yaml
+from settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+FIELD_MAPPING_PATH = get_setting("FIELD_MAPPING_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "field_mapping.json"))
+FIELD_MAPPING_RELOAD_INTERVAL = get_setting("FIELD_MAPPING_RELOAD_INTERVAL", 5.0)
+
+SEARCH_FIELD_PARAM_RE = re.compile(r"search\[fields\]\[(\d+)\]\[(name|value)\]")
+DATE_VALUE_RE = re.compile(r"^(>=|<=|>|<)?\d{4}(-\d{2}(-\d{2})?)?$")
+
+class FieldMappingIndex:
+    """
+    Immutable, versioned index over the search field mapping
+    {field_id: {search_name: field_name}} with O(1) lookups in both directions.
+    """
+    __slots__ = ("version", "forward", "inverse")
+
+    def __init__(self, mapping, version):
+        inverse = {}
+        for field_id, search_modules in mapping.items():
+            for search_name, field_name in search_modules.items():
+                inverse.setdefault(field_name, {})[search_name] = field_id
+
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "forward", MappingProxyType({k: MappingProxyType(dict(v)) for k, v in mapping.items()}))
+        object.__setattr__(self, "inverse", MappingProxyType({k: MappingProxyType(v) for k, v in inverse.items()}))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FieldMappingIndex is immutable")
+
+    def field_id(self, field_name, search_name, default="N/A"):
+        """Returns the field id that maps to field_name in the given search module."""
+        return self.inverse.get(field_name, {}).get(search_name, default)
+
+    def field_name(self, field_id, search_name, default=None):
+        """Returns the module-specific field name for a field id."""
+        return self.forward.get(field_id, {}).get(search_name, default)
+
+def load_field_mapping_index(path=FIELD_MAPPING_PATH):
+    """
+    Loads a FieldMappingIndex from a JSON or YAML file holding
+    {"version": ..., "mapping": {...}}. The index version combines the declared
+    version with a hash of the file so any edit yields a new version.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith((".yaml", ".yml")):
+        document = yaml.safe_load(raw)
+    else:
+        document = json.loads(raw)
+
+    content_hash = hashlib.sha256(raw).hexdigest()[:12]
+    version = f"{document.get('version', 0)}-{content_hash}"
+    return FieldMappingIndex(document["mapping"], version)
+
+_index = None
+_index_mtime = None
+_index_checked_at = 0
+_index_lock = threading.Lock()
+
+def get_field_mapping_index():
+    """
+    Returns the current FieldMappingIndex. The mapping file is re-checked at most
+    every FIELD_MAPPING_RELOAD_INTERVAL seconds, and a changed file is hot
+    reloaded. If the new file cannot be loaded, the previous index stays in use.
+    """
+    global _index, _index_mtime, _index_checked_at
+    now = time.time()
+    if _index is not None and now - _index_checked_at < FIELD_MAPPING_RELOAD_INTERVAL:
+        return _index
+
+    with _index_lock:
+        if _index is not None and now - _index_checked_at < FIELD_MAPPING_RELOAD_INTERVAL:
+            return _index
+        _index_checked_at = now
+        try:
+            mtime = os.path.getmtime(FIELD_MAPPING_PATH)
+            if _index is None or mtime != _index_mtime:
+                new_index = load_field_mapping_index(FIELD_MAPPING_PATH)
+                if _index is not None:
+                    logger.info(f"Field mapping reloaded: {_index.version} -> {new_index.version}")
+                _index, _index_mtime = new_index, mtime
+        except Exception as e:
+            if _index is None:
+                raise
+            logger.error(f"Could not reload field mapping from '{FIELD_MAPPING_PATH}', keeping {_index.version}. Error: {e}")
+        return _index
+
+field_mapping_index = get_field_mapping_index()
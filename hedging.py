@@ -0,0 +1,79 @@
+import asyncio
+import time
+from collections import deque
+from limiter import percentile
+from settings import get_setting
+
+HEDGE_REQUESTS = get_setting("HEDGE_REQUESTS", False)
+HEDGE_PERCENTILE = get_setting("HEDGE_PERCENTILE", 95.0)
+HEDGE_MIN_SAMPLES = get_setting("HEDGE_MIN_SAMPLES", 20)
+HEDGE_BUDGET = get_setting("HEDGE_BUDGET", 0.05)
+
+class HedgePolicy:
+    """
+    Per-run request hedging. Once an endpoint has enough samples, a call that
+    runs past the learned latency percentile gets a duplicate. The first
+    successful response wins and the other call is cancelled. Duplicates are
+    capped at `budget` times the number of requests made so far.
+    """
+
+    def __init__(self, enabled=HEDGE_REQUESTS, pct=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES, budget=HEDGE_BUDGET):
+        self.enabled = enabled
+        self.pct = pct
+        self.min_samples = min_samples
+        self.budget = budget
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies = {}
+
+    def threshold(self, endpoint):
+        samples = self._latencies.get(endpoint)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        return percentile(samples, self.pct)
+
+    def _record(self, endpoint, latency):
+        self._latencies.setdefault(endpoint, deque(maxlen=500)).append(latency)
+
+    def _can_hedge(self):
+        return self.hedges < self.budget * self.requests
+
+    async def call(self, endpoint, fetch):
+        """Awaits fetch(), issuing one duplicate if it exceeds the hedge threshold."""
+        if not self.enabled:
+            return await fetch()
+
+        self.requests += 1
+        start_time = time.time()
+        threshold = self.threshold(endpoint)
+        primary = asyncio.ensure_future(fetch())
+        tasks = {primary}
+        try:
+            if threshold is not None:
+                done, _ = await asyncio.wait(tasks, timeout=threshold)
+                if not done and self._can_hedge():
+                    self.hedges += 1
+                    tasks.add(asyncio.ensure_future(fetch()))
+
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None or len(done) == len(tasks):
+                    break
+                # The first finisher failed; keep waiting for the other call.
+                tasks -= done
+
+            if winner is None:
+                raise next(iter(done)).exception()
+            if winner is not primary:
+                self.hedge_wins += 1
+            self._record(endpoint, time.time() - start_time)
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {"enabled": self.enabled, "requests": self.requests, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
@@ -1,45 +1,67 @@
 import json, ast, yaml, urllib, re, difflib, db_utils, streamlit as st
 from st_copy_to_clipboard import st_copy_to_clipboard
 from keywords_check import *
+from field_mapping import get_field_mapping_index, SEARCH_FIELD_PARAM_RE, DATE_VALUE_RE
+from parse_cache import parse_cache, get_parse_cache_stats
 
-def parse_csv_text_to_json(text_from_csv):
-    if not isinstance(text_from_csv, str) or not text_from_csv.strip():
-        return None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
+def _loads_json(text):
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+def _parse_csv_text(text_from_csv):
     try:
-        return json.loads(text_from_csv)
+        return _loads_json(text_from_csv)
     except json.JSONDecodeError:
         try:
             return ast.literal_eval(text_from_csv)
         except (ValueError, SyntaxError):
             return {"raw_unparseable_text": text_from_csv}
-        
-def convert_yaml_text_to_json(yaml_text):
-    if not isinstance(yaml_text, str) or not yaml_text.strip():
-        return {}
-    
+
+def _parse_yaml_text(yaml_text):
     cleaned_text = yaml_text.replace("```yaml", "").replace("```", "").strip() # This line is the only change
-    
+
+    if orjson is not None and cleaned_text.startswith("{"):
+        # Reconstructed search outputs are stored as JSON, which YAML would also accept.
+        try:
+            parsed_data = orjson.loads(cleaned_text)
+            return parsed_data if isinstance(parsed_data, dict) else {"parsed_content": parsed_data}
+        except orjson.JSONDecodeError:
+            pass
+
     try:
-        parsed_data = yaml.safe_load(cleaned_text)
+        parsed_data = yaml.load(cleaned_text, Loader=YamlSafeLoader)
         return parsed_data if isinstance(parsed_data, dict) else {"parsed_content": parsed_data}
     except yaml.YAMLError:
         return {"raw_unparseable_text": cleaned_text}
 
-def create_inverse_field_map(mapping):
-    """Creates a reverse-lookup map {name: {module: numeric_id}}."""
-    inverse_map = {}
-    for field_id, search_modules in mapping.items():
-        for search_name, new_field_name in search_modules.items():
-            if new_field_name not in inverse_map:
-                inverse_map[new_field_name] = {}
-            inverse_map[new_field_name][search_name] = field_id
-    return inverse_map
+def parse_csv_text_to_json(text_from_csv):
+    if not isinstance(text_from_csv, str) or not text_from_csv.strip():
+        return None
+    return parse_cache.get_or_parse("json", text_from_csv, _parse_csv_text)
+        
+def convert_yaml_text_to_json(yaml_text):
+    if not isinstance(yaml_text, str) or not yaml_text.strip():
+        return {}
+    return parse_cache.get_or_parse("yaml", yaml_text, _parse_yaml_text)
 
 def is_date_value(value):
     """Checks if a string value matches common date formats."""
     # Matches formats like ">=2024-01-01", "2024", "<=2023-12-31"
-    date_pattern = r"^(>=|<=|>|<)?\d{4}(-\d{2}(-\d{2})?)?$"
-    return re.match(date_pattern, value) is not None
+    return DATE_VALUE_RE.match(value) is not None
 
 def parse_search_url(url):
     """Parses the URL fragment to extract the search module and fields."""
@@ -64,7 +86,7 @@ def parse_search_url(url):
         if key == "search[name]":
             search_name = value
         
-        match = re.match(r"search\[fields\]\[(\d+)\]\[(name|value)\]", key)
+        match = SEARCH_FIELD_PARAM_RE.match(key)
         if match:
             index, part = match.groups()
             if index not in fields_dict:
@@ -73,10 +95,11 @@ def parse_search_url(url):
             
     return search_name, [v for k, v in sorted(fields_dict.items())]
 
-def reverse_engineer_search_output(api_url, inverse_map):
+def reverse_engineer_search_output(api_url, field_index=None):
     """
     Reconstructs the search_list_chain_output JSON from the final URL.
     """
+    field_index = field_index or get_field_mapping_index()
     search_name, transformed_fields = parse_search_url(api_url)
 
     if not search_name:
@@ -94,7 +117,7 @@ def reverse_engineer_search_output(api_url, inverse_map):
                 "field_value": field_value
             })
         else:
-            numeric_id = inverse_map.get(field_name, {}).get(search_name, "N/A")
+            numeric_id = field_index.field_id(field_name, search_name)
             for value in field_value.split('|'):
                 reconstructed_fields.append({
                     "field_id": "N/A",
@@ -106,6 +129,12 @@ def reverse_engineer_search_output(api_url, inverse_map):
         "search_fields": reconstructed_fields,
         "search_name": search_name
     }
+URL_VALUE_RE = re.compile(r"['\"]?url['\"]?\s*:\s*['\"]?([^'\"\s]+)['\"]?", re.IGNORECASE)
+
+def _extract_url_text(text_data):
+    match = URL_VALUE_RE.search(text_data)
+    return match.group(1) if match else text_data
+
 def extract_url(text_data):
     if isinstance(text_data, dict):
         return text_data.get('url') 
@@ -113,8 +142,26 @@ def extract_url(text_data):
     if not isinstance(text_data, str):
         return text_data
 
-    match = re.search(r"['\"]?url['\"]?\s*:\s*['\"]?([^'\"\s]+)['\"]?", text_data, re.IGNORECASE)
-    return match.group(1) if match else text_data
+    return parse_cache.get_or_parse("url", text_data, _extract_url_text)
+
+CONVERSATION_TURN_NUMBER_RE = re.compile(r"^(\d+)\.(?!\d)\s*")
+
+def normalize_api_query(user_query):
+    """
+    Returns (api_query, query_type) for a stored user_query. A single query has
+    its whitespace collapsed. A multi-line query is a conversation and becomes one
+    "N. turn" line per non-blank line. Existing numbers are only dropped when every
+    line is numbered 1., 2., ... in order, so a turn that merely starts with a
+    number ("2.5 mg doses") keeps it.
+    """
+    lines = [" ".join(line.split()) for line in str(user_query or "").strip().split('\n')]
+    lines = [line for line in lines if line]
+    if len(lines) <= 1:
+        return (lines[0] if lines else ""), "single"
+    matches = [CONVERSATION_TURN_NUMBER_RE.match(line) for line in lines]
+    if all(match and int(match.group(1)) == i for i, match in enumerate(matches, 1)):
+        lines = [line[match.end():] for line, match in zip(lines, matches)]
+    return "\n".join(f"{i}. {line}" for i, line in enumerate(lines, 1)), "conversational"
 
 def get_diff(text1, text2):
     lines1 = text1.splitlines()
@@ -157,12 +204,19 @@ def render_diff(opcodes, lines1, lines2):
 
     return "".join(left_html), "".join(right_html)
 
-def update_database_record(record_id, updates):
+def execute_write(query, params, writer=None):
+    """Runs a write on the llm database, or hands it to a WriteBehindWriter when one is given."""
+    if writer is not None:
+        writer.submit(query, params)
+    else:
+        db_utils.execute_query("llm", query, params)
+
+def update_database_record(record_id, updates, writer=None):
     if not updates:
         return
 
     set_clauses = ", ".join([f"`{col}` = :{col}" for col in updates.keys()])
-    
+
     if isinstance(record_id, list):
         if not record_id: return
         id_placeholders = ", ".join([f":id_{i}" for i in range(len(record_id))])
@@ -175,7 +229,16 @@ def update_database_record(record_id, updates):
         params = updates.copy()
         params['id'] = record_id
     
-    db_utils.execute_query("llm", query, params)
+    execute_write(query, params, writer)
+
+def delete_database_records(record_ids, writer=None):
+    if not record_ids:
+        return
+
+    id_placeholders = ", ".join([f":id_{i}" for i in range(len(record_ids))])
+    delete_query = f"DELETE FROM `test_results` WHERE `id` IN ({id_placeholders})"
+    params = {f"id_{i}": r_id for i, r_id in enumerate(record_ids)}
+    execute_write(delete_query, params, writer)
 
 def compare_urls(old_url, new_url):
     """
@@ -255,12 +318,21 @@ def display_diff(title, old_data, new_data, row_id, column_name, new_raw_data, b
         st.markdown("<h5>New</h5>", unsafe_allow_html=True)
         st.markdown(right_html, unsafe_allow_html=True)
 
+def get_old_output(result, key):
+    """Old output from the result itself, or from the lazily fetched st.session_state.old_outputs."""
+    if key in result["data"]:
+        return result["data"][key]
+    return st.session_state.get('old_outputs', {}).get(result['id'], {}).get(key)
+
 def render_expander_content(result, buttons_enabled=False):
     """Renders the internal content of a result expander using tabs for clarity."""
     if result.get('error'):
         st.error(f"Could not process row: {result['error']}")
         return
 
+    if result['data'].get('parse_error'):
+        st.warning(f"The stored {result['data']['parse_error']} of this row could not be parsed, so it was compared as empty.")
+
     st.text_area("User Query:", result['user_query'], height=30, key=f"query_{result['id']}")
     
     action_cols = st.columns(3)
@@ -279,6 +351,8 @@ def render_expander_content(result, buttons_enabled=False):
                     'final_output': json.dumps(new_final_raw) if isinstance(new_final_raw, (dict, list)) else new_final_raw
                 }
                 update_database_record(result['id'], updates)
+                from corpus import get_corpus_snapshot
+                get_corpus_snapshot().invalidate([result['id']])
                 st.toast(f"Row `{result['id']}` updated and removed from view.", icon="✅")
                 st.session_state.analysis_results = [r for r in st.session_state.analysis_results if r['id'] != result['id']]
                 st.rerun()
@@ -292,6 +366,8 @@ def render_expander_content(result, buttons_enabled=False):
                     'final_output': result['data']['new_final_raw']
                 }
                 db_utils.add_full_alternative_record(row_id, new_data)
+                from corpus import get_corpus_snapshot
+                get_corpus_snapshot().mark_own_write()
                 st.toast(f"Group '{row_id}' updated and removed from view.", icon="✅")
                 st.session_state.analysis_results = [r for r in st.session_state.analysis_results if r['id'].split('-')[0] != row_id]
                 st.rerun()
@@ -318,12 +394,12 @@ def render_expander_content(result, buttons_enabled=False):
         # Populate the NER tab if it exists
         if "NER Output" in tab_map:
             with tab_map["NER Output"]:
-                display_diff("NER Output Difference", result["data"]["old_ner"], result["data"]["new_ner"], result['id'], 'ner_output', result['data']['new_ner_raw'])
+                display_diff("NER Output Difference", get_old_output(result, "old_ner"), result["data"]["new_ner"], result['id'], 'ner_output', result['data']['new_ner_raw'])
         
         # Populate the Search tab if it exists
         if "Search Output" in tab_map:
             with tab_map["Search Output"]:
-                display_diff("Search Output Difference", result["data"]["old_search"], result["data"]["new_search"], result['id'], 'search_list_chain_output', result['data']['new_search_raw'])
+                display_diff("Search Output Difference", get_old_output(result, "old_search"), result["data"]["new_search"], result['id'], 'search_list_chain_output', result['data']['new_search_raw'])
 
         # Populate the Final tab if it exists
         if "Final Output" in tab_map:
@@ -340,309 +416,3 @@ def display_result_expander(result, buttons_enabled=False):
     if result.get('failed'):
         with st.expander(f"🚨 ID: {result['id']}"):
             render_expander_content(result, buttons_enabled)
-
-
-reconstructed_search_mapping = {
-    "highly_potent": {"compound": "highly_potent", "molecule": "highly_potent"},
-    "therapeutic_category_s": {
-        "compound": "therapeutic_category_s",
-        "molecule": "therapeutic_category_s",
-        "news": "therapeutic_category_s",
-        "deal": "therapeutic_category_s",
-        "venture": "therapeutic_category_s",
-        "technology": "therapeutic_category_s",
-        "discovery_technology": "pp_therapeutic_category",
-        "company": "therapeutic_category_s",
-        "howsupplied": "therapeutic_category_s",
-        "howsupplied_injectable": "therapeutic_category_s",
-    },
-    "highest_phase_compound": {
-        "compound": "highest_phase_compound",
-        "molecule": "highest_phase",
-        "news": "highest_phase",
-        "deal": "highest_phase",
-        "venture": "highest_phase",
-        "technology": "development_stage",
-        "company": "highest_phase_compound",
-        "discovery_technology": "highest_phase",
-        "howsupplied": "highest_phase_compound",
-        "howsupplied_injectable": "highest_phase_compound",
-    },
-    "phase": {"compound": "phase"},
-    "activity": {
-        "compound": "activity",
-        "technology": "activity",
-        "company": "company_is_active",
-        "howsupplied": "activity",
-        "howsupplied_injectable": "activity",
-    },
-    "product_name_s": {
-        "compound": "product_name_s",
-        "news": "compound_name_s",
-        "deal": "product_name_s",
-        "discovery_technology": "compound_name_s",
-        "paragraph_iv": "innovator_compound_s",
-        "howsupplied": "product_name_s",
-        "howsupplied_injectable": "product_name_s",
-    },
-    "generic_or_innovator": {
-        "compound": "generic_or_innovator",
-        "molecule": "generic_or_innovator",
-        "news": "generic_or_innovator",
-        "deal": "generic_or_innovator",
-        "venture": "generic_or_innovator",
-        "technology": "generic_or_innovator",
-        "company": "generic_or_innovator",
-        "howsupplied": "generic_or_innovator",
-        "howsupplied_injectable": "generic_or_innovator",
-    },
-    "company_name_s": {
-        "compound": "company_name_s",
-        "molecule": "company_name_s",
-        "news": "company_name_s",
-        "deal": "company_name_s",
-        "venture": "company_name_s",
-        "technology": "company_name_s",
-        "discovery_technology": "company_name_s",
-        "company": "company_name_s",
-        "howsupplied": "company_name_s",
-        "howsupplied_injectable": "company_name_s",
-    },
-    "molecule_name_s": {
-        "compound": "molecule_name_s",
-        "molecule": "molecule_name_s",
-        "news": "molecule_name_s",
-        "deal": "molecule_name_s",
-        "venture": "molecule_name_s",
-        "technology": "molecule_name_s",
-        "company": "molecule_name_s",
-        "paragraph_iv": "innovator_molecule",
-        "howsupplied": "molecule_name_s",
-        "howsupplied_injectable": "molecule_name_s",
-    },
-    "molecule_api_group": {
-        "compound": "molecule_api_group",
-        "molecule": "molecule_api_group",
-        "news": "molecule_api_group",
-        "deal": "molecule_api_group",
-        "venture": "molecule_api_group",
-        "technology": "molecule_api_group",
-        "company": "molecule_api_group",
-        "discovery_technology": "molecule_api_group",
-        "howsupplied": "molecule_api_group",
-        "howsupplied_injectable": "molecule_api_group",
-    },
-    "conjugate_molecule_types": {
-        "compound": "conjugate_molecule_types",
-        "molecule": "conjugate_molecule_types",
-        "deal": "conjugate_molecule_types",
-        "news": "conjugate_molecule_types",
-        "venture": "conjugate_molecule_types",
-        "technology": "technology_molecule_types",
-        "discovery_technology": "disco_molecule_types",
-        "company": "conjugate_molecule_types",
-        "howsupplied": "molecule_type",
-        "howsupplied_injectable": "conjugate_molecule_types",
-    },
-    "mechanism_type_s": {
-        "compound": "mechanism_type_s",
-        "molecule": "mechanism_type_s",
-        "venture": "mechanism_type",
-        "deal": "mechanism_type_s",
-        "company": "mechanism_type_s",
-        "howsupplied": "mechanism_type_s",
-        "howsupplied_injectable": "mechanism_type_s",
-    },
-    "route_branch_s": {
-        "compound": "route_branch_s",
-        "molecule": "route_branch_injection",
-        "news": "route_branch_injection",
-        "deal": "route_branch_injection",
-        "venture": "route_branch_injection",
-        "technology": "route_technology_injection",
-        "company": "route_s",
-        "discovery_technology": "route_branch",
-        "howsupplied": "route_s",
-        "howsupplied_injectable": "route_branch_s",
-    },
-    "drug_delivery_branch_s": {
-        "compound": "drug_delivery_branch_s",
-        "molecule": "drug_delivery_branch_s",
-        "news": "drug_delivery_branch",
-        "deal": "drug_delivery_branch_s",
-        "venture": "drug_delivery_branch_s",
-        "technology": "drug_delivery_branch_compound_s",
-        "company": "drug_delivery_branch_s",
-        "howsupplied": "drug_delivery_branch_s",
-        "howsupplied_injectable": "drug_delivery_branch_s",
-    },
-    "antibody_type": {
-        "compound": "antibody_type",
-        "molecule": "antibody_type",
-        "howsupplied": "antibody_type",
-        "howsupplied_injectable": "antibody_type",
-    },
-    "antibody_source": {"compound": "antibody_source", "molecule": "antibody_source"},
-    "antibody_class": {"compound": "antibody_class", "molecule": "antibody_class"},
-    "antibody_fragment": {
-        "compound": "antibody_fragment",
-        "molecule": "antibody_fragment",
-    },
-    "bispecific_antibody": {
-        "compound": "bispecific_antibody",
-        "molecule": "bispecific_antibody",
-    },
-    "is_prodrug": {"compound": "is_prodrug", "molecule": "is_prodrug"},
-    "fusion_protein": {"compound": "fusion_protein", "molecule": "fusion_protein"},
-    "cell_source": {"compound": "cell_source", "molecule": "cell_source"},
-    "release_profile": {"compound": "release_profile", "molecule": "release_profile"},
-    "expression_organism": {"molecule": "expression_organism"},
-    "target_type": {"compound": "target_type", "molecule": "target_type"},
-    "target_name_s": {"compound": "target_name_s", "molecule": "target_name_s"},
-    "immunooncology": {"compound": "immunooncology"},
-    "vaccine_type": {"compound": "vaccine_type", "deal": "vaccine_type"},
-    "vaccine_or_adjuvant": {
-        "compound": "vaccine_or_adjuvant",
-        "news": "vaccine_or_adjuvant",
-        "deal": "vaccine_or_adjuvant",
-        "technology": "vaccine_or_adjuvant",
-        "company": "vaccine_or_adjuvant",
-        "howsupplied_injectable": "vaccine_or_adjuvant",
-    },
-    "charged_molecule": {
-        "compound": "charged_molecule",
-        "molecule": "charged_molecule",
-    },
-    "water_solubility": {
-        "compound": "water_solubility",
-        "molecule": "water_solubility",
-        "howsupplied": "water_solubility",
-        "howsupplied_injectable": "water_solubility",
-    },
-    "estimated_water_solubility": {
-        "compound": "estimated_water_solubility",
-        "molecule": "estimated_water_solubility",
-    },
-    "BCS_classification_s": {
-        "compound": "BCS_classification_s",
-        "molecule": "BCS_classification",
-        "howsupplied": "bcs_classification_s",
-    },
-    "chiral_form": {"molecule": "chiral_form"},
-    "logp_reported": {"compound": "logP", "molecule": "logP"},
-    "melting_point": {"compound": "melting_point_all", "molecule": "melting_point"},
-    "pka_field": {"molecule": "pKa"},
-    "molecular_weight": {"molecule": "molecular_weight"},
-    "elimination_pathway": {"molecule": "elimination_pathway"},
-    "is_the_metabolite_active": {"molecule": "is_the_metabolite_active"},
-    "plasma_protein_binding": {"molecule": "plasma_protein_binding"},
-    "volume_of_distribution": {"molecule": "volume_of_distribution"},
-    "oral_bioavailability": {"molecule": "oral_bioavailability_percent"},
-    "clearance": {"molecule": "clearance"},
-    "elimination": {"molecule": "elimination_half_life"},
-    "food_effect": {"compound": "food_effect", "molecule": "food_effect"},
-    "p_gp_effect": {"molecule": "p_gp_effect"},
-    "injection_site": {
-        "compound": "injection_site",
-        "howsupplied_injectable": "injection_site",
-        "technology": "injection_site",
-    },
-    "dose_per_admin": {
-        "howsupplied": "dose_per_admin",
-        "howsupplied_injectable": "dose_per_admin",
-    },
-    "daily_dose": {"howsupplied": "daily_dose", "howsupplied_injectable": "daily_dose"},
-    "injection_volume": {
-        "howsupplied": "injection_volume",
-        "howsupplied_injectable": "injection_volume",
-    },
-    "form_name_basic": {
-        "compound": "form_name_s",
-        "molecule": "molecule_dosage_form_s",
-        "news": "form_name_s",
-        "deal": "dosage_form",
-        "venture": "dosage_form",
-        "technology": "dosage_form",
-        "company": "form_name_s",
-        "discovery_technology": "dosage_form",
-        "howsupplied": "form_name_s",
-        "howsupplied_injectable": "form_name_s",
-    },
-    "dd_device_category": {
-        "compound": "dd_device_category",
-        "news": "dd_device",
-        "technology": "dd_device_category",
-        "howsupplied": "dd_device_category",
-        "howsupplied_injectable": "dd_device_category",
-    },
-    "excipient_name_s": {
-        "howsupplied": "excipient_name_s",
-        "howsupplied_injectable": "excipient_name_s",
-    },
-    "preservative_free": {
-        "howsupplied": "preservative_free",
-        "howsupplied_injectable": "preservative_free",
-    },
-    "light_sensitive": {
-        "howsupplied": "light_sensitive",
-        "howsupplied_injectable": "light_sensitive",
-    },
-    "storage_temp": {
-        "howsupplied": "storage_temp",
-        "howsupplied_injectable": "storage_temp",
-    },
-    "name_s": {
-        "compound": "technology_s",
-        "news": "technology_name",
-        "deal": "technology_s",
-        "technology": "name_s",
-        "howsupplied": "technology_s",
-        "howsupplied_injectable": "technology_s",
-    },
-    "name": {"discovery_technology": "name"},
-    "ingredient_volume": {"howsupplied_injectable": "ingredient_volume"},
-    "pH": {"howsupplied": "pH", "howsupplied_injectable": "pH"},
-    "color": {"howsupplied": "color"},
-    "tablet_capsule_shape": {"howsupplied": "tablet_capsule_shape"},
-    "tablet_coating": {"howsupplied": "tablet_coating"},
-    "is_minitablet": {"howsupplied": "is_minitablet"},
-    "length": {"howsupplied": "length"},
-    "glass_type": {"howsupplied_injectable": "glass_type"},
-    "package_color": {"howsupplied_injectable": "package_color"},
-    "supplied_as_kit": {"howsupplied_injectable": "supplied_as_kit"},
-    "primary_packaging": {"howsupplied": "primary_packaging"},
-    "is_505_2_b": {"compound": "is_505_2_b"},
-    "is_orphan": {
-        "compound": "is_orphan",
-        "howsupplied": "is_orphan",
-        "howsupplied_injectable": "is_orphan",
-    },
-    "earliest_approval_date": {"compound": "earliest_approval_date"},
-    "usa_earliest_approval_date": {"compound": "usa_earliest_approval_date"},
-    "europe_earliest_approval_date": {"compound": "europe_earliest_approval_date"},
-    "device_approval_date_s": {"technology": "device_approval_date_s"},
-    "owner_company_private_public": {"company": "company_private_public"},
-    "owner_company_business_model": {
-        "news": "business_model",
-        "deal": "type",
-        "company": "company_business_model_exact",
-    },
-    "owner_company_major_business_model": {"company": "major_business_model"},
-    "company_city": {"company": "company_city"},
-    "company_territory": {
-        "company": "company_territory",
-        "compound": "owner_company_territory",
-    },
-    "owner_company_US_state": {"company": "company_US_state"},
-    "company_year_founded": {"company": "company_year_founded"},
-    "news_branch": {"news": "news_type", "deal": "news_branch"},
-    "amendment_termination": {"deal": "amendment_termination"},
-    "pharma_services_type": {"deal": "pharma_services_type"},
-    "royalty_type": {"deal": "royalty_type"},
-    "royalty_digit": {"deal": "royalty_digit"},
-    "is_deal_cancelled": {"deal": "is_deal_cancelled"},
-    "deal_date": {"deal": "date"},
-    "news_date": {"news": "date"},
-    "security_type": {"venture": "security_type"},
-    "venture_type": {"venture": "venture_type"},
-}
@@ -0,0 +1,138 @@
+import asyncio
+import contextlib
+import threading
+import time
+from collections import deque
+import aiohttp
+from engine import MAX_CONCURRENCY
+from settings import get_setting
+
+API_LIMIT_INITIAL = get_setting("API_LIMIT_INITIAL", 10)
+API_LIMIT_MIN = get_setting("API_LIMIT_MIN", 1)
+API_LIMIT_MAX = get_setting("API_LIMIT_MAX", MAX_CONCURRENCY)
+API_LIMIT_WINDOW = get_setting("API_LIMIT_WINDOW", 20)
+API_LIMIT_STEP = get_setting("API_LIMIT_STEP", 2)
+API_LIMIT_BACKOFF = get_setting("API_LIMIT_BACKOFF", 0.5)
+API_LIMIT_LATENCY_TOLERANCE = get_setting("API_LIMIT_LATENCY_TOLERANCE", 1.5)
+API_LIMIT_MAX_ERROR_RATE = get_setting("API_LIMIT_MAX_ERROR_RATE", 0.05)
+
+def is_overload_error(error):
+    """Timeouts, 5xx responses and dropped connections mean the backend is saturated."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on concurrent API calls. After every window of completed calls
+    the limit grows by a fixed step while the p95 latency stays within tolerance
+    of its baseline and the error rate is low. It is cut multiplicatively when the
+    p95 rises, and straight away on timeouts, 5xx responses or dropped connections.
+    """
+
+    def __init__(self, initial=API_LIMIT_INITIAL, min_limit=API_LIMIT_MIN, max_limit=API_LIMIT_MAX):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial, max_limit))
+        self.history = deque([(time.time(), self.limit, "start")], maxlen=2000)
+        self._lock = threading.Lock()
+        self._cond = None
+        self._in_flight = 0
+        self._latencies = []
+        self._errors = 0
+        self._baseline_p95 = None
+        self._last_decrease = 0
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Holds one concurrency slot for the duration of an API call."""
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+        start_time = time.time()
+        error = None
+        cancelled = False
+        try:
+            yield
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if not cancelled:
+                self._record(time.time() - start_time, error)
+            async with cond:
+                self._in_flight -= 1
+                cond.notify_all()
+
+    def _record(self, latency, error):
+        with self._lock:
+            if error is not None and is_overload_error(error):
+                self._errors += 1
+                if time.time() - self._last_decrease > 1.0:
+                    self._decrease(f"{type(error).__name__}")
+            elif error is None:
+                self._latencies.append(latency)
+
+            if len(self._latencies) + self._errors < API_LIMIT_WINDOW:
+                return
+
+            completed = len(self._latencies) + self._errors
+            error_rate = self._errors / completed
+            p95 = percentile(self._latencies, 95)
+            self._latencies, self._errors = [], 0
+
+            if self._baseline_p95 is None:
+                self._baseline_p95 = p95
+            if error_rate > API_LIMIT_MAX_ERROR_RATE:
+                self._decrease(f"error rate {error_rate:.0%}")
+            elif p95 > self._baseline_p95 * API_LIMIT_LATENCY_TOLERANCE:
+                self._decrease(f"p95 {p95:.2f}s over baseline {self._baseline_p95:.2f}s")
+            else:
+                self._set_limit(self.limit + API_LIMIT_STEP, f"p95 {p95:.2f}s")
+            # Follow latency down immediately, but let the baseline drift up slowly.
+            self._baseline_p95 = min(p95, self._baseline_p95 * 1.05) if p95 else self._baseline_p95
+
+    def _decrease(self, reason):
+        self._last_decrease = time.time()
+        self._set_limit(int(self.limit * API_LIMIT_BACKOFF), reason)
+
+    def _set_limit(self, limit, reason):
+        limit = max(self.min_limit, min(limit, self.max_limit))
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append((time.time(), limit, reason))
+
+    def snapshot(self, since=0):
+        """Returns the current limit and the limit changes recorded after `since`."""
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "history": [entry for entry in self.history if entry[0] >= since],
+            }
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = AdaptiveLimiter()
+        return _limiter
@@ -0,0 +1,111 @@
+import json
+import sqlite3
+import threading
+import time
+import logging
+import pandas as pd
+from settings import get_setting
+from sqlite_backend import create_test_results_table
+
+logger = logging.getLogger(__name__)
+
+LOCAL_SNAPSHOT_PATH = get_setting("LOCAL_SNAPSHOT_PATH", "corpus_snapshot.sqlite3")
+LOCAL_SNAPSHOT_ENABLED = get_setting("LOCAL_SNAPSHOT_ENABLED", True)
+OFFLINE_MODE = get_setting("OFFLINE_MODE", False)
+
+class LocalSnapshotStore:
+    """
+    Local SQLite copy of the corpus. `test_results` mirrors the raw MySQL rows in
+    the SQLite backend's schema, so OFFLINE_MODE can use this file as the database.
+    `corpus` holds the slim preprocessed frame, so a cold start only has to decode
+    one table instead of downloading and re-parsing everything.
+    """
+
+    def __init__(self, path=LOCAL_SNAPSHOT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def _get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def synced_at(self):
+        with self._lock:
+            return self._get_meta("synced_at")
+
+    def load_corpus(self):
+        """Returns the stored preprocessed corpus frame, or None if there is none yet."""
+        with self._lock:
+            dtypes = self._get_meta("corpus_dtypes")
+            if dtypes is None:
+                return None
+            df = pd.read_sql("SELECT * FROM corpus", self._conn)
+
+        for col, dtype in dtypes.items():
+            if dtype == "object":
+                df[col] = [json.loads(value) if not _is_missing(value) else None for value in df[col]]
+            elif dtype.startswith("datetime"):
+                df[col] = pd.to_datetime(df[col])
+            elif dtype == "bool":
+                df[col] = df[col].astype(bool)
+        return df
+
+    def save_corpus(self, df):
+        """Replaces the stored preprocessed corpus. Object columns are stored as JSON."""
+        encoded = df.copy()
+        dtypes = {col: str(dtype) for col, dtype in df.dtypes.items()}
+        for col, dtype in dtypes.items():
+            if dtype == "object":
+                encoded[col] = [json.dumps(value, default=str) if not _is_missing(value) else None for value in df[col]]
+
+        with self._lock:
+            encoded.to_sql("corpus", self._conn, if_exists="replace", index=False)
+            self._set_meta("corpus_dtypes", dtypes)
+            self._set_meta("synced_at", time.time())
+            self._conn.commit()
+
+    def replace_raw(self, raw_df):
+        """Replaces the raw test_results mirror, using the schema of the SQLite backend."""
+        with self._lock:
+            self._conn.execute("DROP TABLE IF EXISTS test_results")
+            create_test_results_table(self._conn, raw_df.columns)
+            raw_df.drop(columns=['id'], errors='ignore').to_sql("test_results", self._conn, if_exists="append", index=False)
+            self._conn.commit()
+
+    def upsert_raw(self, changed_df, removed_ids=()):
+        """Applies a delta to the raw mirror: rewrites the changed rows and drops removed ids."""
+        ids = list(changed_df['id']) + list(removed_ids)
+        with self._lock:
+            if not self._has_table("test_results"):
+                return
+            self._conn.executemany("DELETE FROM test_results WHERE id = ?", [(r_id,) for r_id in ids])
+            if not changed_df.empty:
+                changed_df.drop(columns=['id'], errors='ignore').to_sql("test_results", self._conn, if_exists="append", index=False)
+            self._conn.commit()
+
+    def _has_table(self, name):
+        return self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and pd.isna(value))
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_local_snapshot_store():
+    """Returns the local snapshot store, or None when it is disabled."""
+    global _store
+    if not LOCAL_SNAPSHOT_ENABLED and not OFFLINE_MODE:
+        return None
+    with _store_lock:
+        if _store is None:
+            logger.info(f"Opening local corpus snapshot at '{LOCAL_SNAPSHOT_PATH}'...")
+            _store = LocalSnapshotStore()
+        return _store
@@ -2,7 +2,18 @@ from helpers import *
 from streams import *
 from process_functions import *
 from process_row import *
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from engine import get_engine
+from transport import get_transport_stats, reset_transport_stats
+from response_cache import RESPONSE_CACHE_MODE, BACKEND_VERSION
+from run_context import RunContext
+from pipeline import start_pipeline
+from corpus import get_group_records, get_corpus_snapshot, fetch_old_outputs
+from local_snapshot import OFFLINE_MODE, LOCAL_SNAPSHOT_PATH
+from duplicate_index import DuplicateQueryIndex
+from writer import WriteBehindWriter, WRITER_FAILURE_REPORT_PATH
+from limiter import get_limiter
+from settings import get_setting
+from concurrent.futures import as_completed
 import threading
 import streamlit_nested_layout
 import pandas as pd
@@ -10,8 +21,33 @@ import pandas as pd
 st.set_page_config(layout="wide")
 st.title("Agentic-flow tester")
 st.markdown("Click Run Analysis to start the tester.")
+if RESPONSE_CACHE_MODE in ("record", "replay"):
+    st.caption(f"Response cache is in {RESPONSE_CACHE_MODE} mode for backend version '{BACKEND_VERSION}'.")
+LIVE_RENDER_BATCH = get_setting("LIVE_RENDER_BATCH", 10)
+LIVE_RENDER_INTERVAL = get_setting("LIVE_RENDER_INTERVAL", 2.0)
+
 depth_toggle = st.toggle("Depth", help="Activate to use the agent-based stream for a deeper analysis.")
 
+def render_live_groups(batch):
+    """Loads the stored outputs of a batch of failed groups in one query, then draws the groups."""
+    missing_ids = [r['id'] for group_results in batch for r in group_results if r.get('failed') and 'data' in r and r['id'] not in st.session_state.old_outputs]
+    if missing_ids:
+        st.session_state.old_outputs.update(fetch_old_outputs(missing_ids))
+
+    for group_results in batch:
+        # Case 1: The group failed, but only has one alternative. Display it directly.
+        if len(group_results) == 1:
+            display_result_expander(group_results[0], buttons_enabled=False)
+        # Case 2: The group failed and has multiple alternatives. Create a nested view.
+        else:
+            row_id = group_results[0]['id'].split('-')[0]
+            with st.expander(f"🚨 Row ID: {row_id}"):
+                for result in group_results:
+                    # Create a nested expander for each specific ID
+                    with st.expander(f"ID: {result['id']}"):
+                        # Render the content directly inside the nested expander
+                        render_expander_content(result, buttons_enabled=False)
+
 def main():
     if 'analysis_results' not in st.session_state:
         st.session_state.analysis_results = None
@@ -21,17 +57,27 @@ def main():
         st.session_state.analysis_summary = None
     if 'df_to_process' not in st.session_state:
         st.session_state.df_to_process = None
+    if 'cancel_report' not in st.session_state:
+        st.session_state.cancel_report = None
+    if 'old_outputs' not in st.session_state:
+        st.session_state.old_outputs = {}
+    if 'run_filter' not in st.session_state:
+        st.session_state.run_filter = {"intents": [], "query_types": []}
 
     df = None
     max_retries = 3
     status_placeholder = st.empty()
+    corpus_snapshot = get_corpus_snapshot()
 
     for attempt in range(max_retries):
-        status_placeholder.info(f"⚙️ Connecting to the database... (Attempt {attempt + 1}/{max_retries})")
-        df = db_utils.fetch_dataframe("llm", "SELECT * FROM test_results")
+        first_load = corpus_snapshot.df is None and not OFFLINE_MODE
+        if first_load:
+            status_placeholder.info(f"⚙️ Connecting to the database... (Attempt {attempt + 1}/{max_retries})")
+        df = corpus_snapshot.load()
         if df is not None:
-            status_placeholder.success("✅ Database connected successfully!")
-            time.sleep(1.5) 
+            if first_load and corpus_snapshot.last_refresh['kind'] == "full":
+                status_placeholder.success("✅ Database connected successfully!")
+                time.sleep(1.5) 
             status_placeholder.empty() 
             break 
         else:
@@ -41,8 +87,22 @@ def main():
                 status_placeholder.error("❌ Database connection failed. Please refresh the page to try again.")
                 st.stop() 
     st.success(f"Successfully loaded {df['row_id'].nunique()} unique test cases from the database.")
+    if OFFLINE_MODE:
+        st.info(f"Offline mode: the test corpus is read from the local snapshot '{LOCAL_SNAPSHOT_PATH}' only.")
+    elif corpus_snapshot.is_syncing():
+        st.caption("Syncing the local corpus snapshot with the database in the background...")
+
+    _, group_index = get_group_records(df)
+    filter_cols = st.columns(2)
+    with filter_cols[0]:
+        selected_intents = st.multiselect("Intents", sorted(group_index.by_intent), format_func=lambda intent: f"{intent} ({len(group_index.by_intent[intent])})", help="Only run groups with these NER intents. Leave empty to run all groups.")
+    with filter_cols[1]:
+        selected_query_types = st.multiselect("Query types", sorted(group_index.by_query_type), format_func=lambda query_type: f"{query_type} ({len(group_index.by_query_type[query_type])})", help="Only run groups of these query types. Leave empty to run all groups.")
 
     if st.button("Run Analysis", use_container_width=True):
+        st.session_state.run_filter = {"intents": selected_intents, "query_types": selected_query_types}
+        st.session_state.cancel_report = None
+        st.session_state.old_outputs = {}
         st.session_state.df_to_process = df
         st.session_state.analysis_running = True
         st.session_state.analysis_results = []
@@ -56,85 +116,91 @@ def main():
         analysis_start_time = time.time()
         df_to_process = st.session_state.df_to_process
 
-        empty_mask = pd.isnull(df_to_process['ner_output']) | (df_to_process['ner_output'].astype(str).str.strip() == "") | (df_to_process['ner_output'].astype(str).str.strip() == "{}")
-        df_empty = df_to_process[empty_mask]
-
-        if not df_empty.empty:
-            with st.spinner("Filling empty rows..."):
-                status_text = st.empty()
-                grouped_empty = df_empty.groupby('row_id')
-                total_empty_groups = len(grouped_empty)
-
-                for i, (row_id, group_df) in enumerate(grouped_empty):
-                    status_text.text(f"Processing empty row_id: {row_id} ({i + 1}/{total_empty_groups})")
-                    fill_empty_row_group(group_df)
-
-                st.session_state.df_to_process = db_utils.fetch_dataframe("llm", "SELECT * FROM test_results")
-                df_to_process = st.session_state.df_to_process
-                status_text.empty()
-
         progress_bar = st.progress(0, text="Starting analysis...")
         summary_placeholder = st.empty()
         results_container = st.container()
         
+        group_records, group_index = get_group_records(df_to_process)
+        run_filter = st.session_state.run_filter
+        selected_ids = group_index.select(run_filter['intents'], run_filter['query_types'], depth_toggle)
+        group_records = {row_id: records for row_id, records in group_records.items() if row_id in selected_ids}
+
         failed_count = 0
         deleted_count = 0
-        total_rows = len(df_to_process)
+        total_rows = sum(len(records) for records in group_records.values())
         live_results = []
         latencies = []
         stop_event = threading.Event()
         
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            grouped = df_to_process.groupby('row_id')
-            future_to_group = {executor.submit(process_row_group, row_id, group_df, depth_toggle, stop_event): row_id for row_id, group_df in grouped}            
-            processed_groups = 0
-            total_groups = len(grouped)
+        engine = get_engine()
+        reset_transport_stats()
+        db_utils.reset_db_stats()
+        run = RunContext(DuplicateQueryIndex.from_dataframe(df_to_process), WriteBehindWriter())
+        pipeline = start_pipeline(engine, run, depth_toggle, stop_event)
+        future_to_group = {engine.submit(pipeline.process(row_id, records)): row_id for row_id, records in group_records.items()}
+        processed_groups = 0
+        processed_rows_count = 0
+        total_groups = len(group_records)
+        pending_render, pending_since = [], 0
+        try :
             try :
-                try :
-                    for future in as_completed(future_to_group):
-                        row_id = future_to_group[future]
-                        processed_groups += 1
-                        group_results, latency = future.result() # This will be a list of failed results for the group
+                for future in as_completed(future_to_group):
+                    row_id = future_to_group[future]
+                    processed_groups += 1
+                    processed_rows_count += len(group_records[row_id])
+                    group_results, latency = future.result() # This will be a list of failed results for the group
+
+                    if latency > 0:
+                        latencies.append((row_id,latency))
 
-                        if latency > 0:
-                            latencies.append((row_id,latency))
+                    if group_results:
+                        # Extend the main results list with the list of failures from the group
+                        live_results.extend(group_results)
+                        failed_count += len(group_results)
 
-                        if group_results:
-                            # Extend the main results list with the list of failures from the group
-                            live_results.extend(group_results)
-                            failed_count += len(group_results)
+                        # Failed groups are drawn in batches, once their stored outputs are loaded
+                        if not pending_render:
+                            pending_since = time.time()
+                        pending_render.append(group_results)
 
+                    if pending_render and (len(pending_render) >= LIVE_RENDER_BATCH or time.time() - pending_since >= LIVE_RENDER_INTERVAL):
                         with results_container:
-                            if group_results:
-                                # Case 1: The group failed, but only has one alternative. Display it directly.
-                                if len(group_results) == 1:
-                                    display_result_expander(group_results[0], buttons_enabled=False)
-                                # Case 2: The group failed and has multiple alternatives. Create a nested view.
-                                else:
-                                    row_id = group_results[0]['id'].split('-')[0]
-                                    with st.expander(f"🚨 Row ID: {row_id}"):
-                                        for result in group_results:
-                                            # Create a nested expander for each specific ID
-                                            with st.expander(f"ID: {result['id']}"):
-                                                # Render the content directly inside the nested expander
-                                                render_expander_content(result, buttons_enabled=False)
-
-                        processed_rows_count = sum(len(g) for _, g in list(grouped)[:processed_groups])
-                        summary_placeholder.info(f"Processed: {processed_rows_count}/{total_rows} rows ({processed_groups}/{total_groups} groups) | Failures: {failed_count}")
-                        progress_bar.progress(processed_groups / total_groups, text=f"Processing group {processed_groups}/{total_groups}")
-                except Exception as e:
-                    st.error(f"❌ An error occurred during analysis in group '{row_id}':")
-                    st.exception(e) 
-                    stop_event.set()  # Signal all threads to stop
-                    st.session_state.analysis_running = False
-                    st.stop()
-            finally:
-                # This code will ALWAYS run, even if the user clicks "Stop"
-                print("Stop signal sent to all threads.") # For debugging
-                stop_event.set()
+                            render_live_groups(pending_render)
+                        pending_render = []
 
-            
+                    queue_depths = " ".join(f"{name} {depth}" for name, depth in pipeline.queue_depths().items())
+                    summary_placeholder.info(f"Processed: {processed_rows_count}/{total_rows} rows ({processed_groups}/{total_groups} groups) | Failures: {failed_count} | API concurrency limit: {get_limiter().limit} | Queues: {queue_depths}")
+                    progress_bar.progress(processed_groups / total_groups, text=f"Processing group {processed_groups}/{total_groups}")
 
+                if pending_render:
+                    with results_container:
+                        render_live_groups(pending_render)
+            except Exception as e:
+                st.error(f"❌ An error occurred during analysis in group '{row_id}':")
+                st.exception(e) 
+                stop_event.set()  # Signal all threads to stop
+                st.session_state.analysis_running = False
+                st.stop()
+        finally:
+            # This code will ALWAYS run, even if the user clicks "Stop"
+            stop_event.set()
+            in_flight_groups = len(run.active_groups)
+            cancelled_groups = engine.cancel(future_to_group)
+            if cancelled_groups:
+                st.session_state.cancel_report = {
+                    "completed": processed_groups,
+                    "in_flight_aborted": min(in_flight_groups, cancelled_groups),
+                    "queued_skipped": max(0, cancelled_groups - in_flight_groups),
+                }
+                st.session_state.analysis_results = live_results
+                st.session_state.analysis_running = False
+            print(f"Stop signal sent to all tasks, {cancelled_groups} unfinished groups cancelled.") # For debugging
+            engine.run(pipeline.close())
+            run.writer.close()
+            if pipeline.deleted_groups:
+                corpus_snapshot.mark_own_write()
+            # Keep the filled rows without reloading the table
+            corpus_snapshot.apply_fills(pipeline.filled)
 
         total_runtime = time.time() - analysis_start_time
         avg_latency = sum(lat for _, lat in latencies) / len(latencies) if latencies else 0
@@ -149,13 +215,22 @@ def main():
             "total_runtime": total_runtime,
             "avg_latency": avg_latency,
             "max_latency": max_latency,
-            "max_latency_row_id": max_latency_row_id
+            "max_latency_row_id": max_latency_row_id,
+            "transport": get_transport_stats(),
+            "database": db_utils.get_db_stats(),
+            "run": run.stats(),
+            "limiter": get_limiter().snapshot(since=analysis_start_time),
+            "parse_cache": get_parse_cache_stats(),
+            "start_time": analysis_start_time
         }
         st.session_state.analysis_running = False
         st.rerun()
 
     elif st.session_state.analysis_results is not None:
         st.header("Analysis Results")
+        cancel_report = st.session_state.cancel_report
+        if cancel_report:
+            st.warning(f"⏹️ Run stopped after {cancel_report['completed']} groups: {cancel_report['in_flight_aborted']} in-flight groups aborted, {cancel_report['queued_skipped']} queued groups skipped.")
         summary = st.session_state.analysis_summary
         if summary:
             st.subheader("Performance Metrics")
@@ -169,6 +244,68 @@ def main():
             with stat_cols[3]:
                 st.metric(label="Slowest Row ID", value=summary.get('max_latency_row_id', 'N/A'))
 
+            transport_stats = summary.get('transport')
+            if transport_stats:
+                transport_cols = st.columns(4)
+                with transport_cols[0]:
+                    st.metric(label="API Requests", value=transport_stats['requests'])
+                with transport_cols[1]:
+                    st.metric(label="New Connections", value=transport_stats['new_connections'])
+                with transport_cols[2]:
+                    st.metric(label="Reused Connections", value=transport_stats['reused_connections'])
+                with transport_cols[3]:
+                    st.metric(label="Connection Reuse", value=f"{transport_stats['reuse_ratio']:.0%}")
+
+            prefix_stats = summary.get('run', {}).get('prefix_cache')
+            if prefix_stats and prefix_stats['reused_turns']:
+                st.caption(f"Conversation prefix cache: {prefix_stats['reused_turns']} turns reused, {prefix_stats['fetched_turns']} turns sent to the API.")
+
+            singleflight_stats = summary.get('run', {}).get('singleflight')
+            if singleflight_stats and singleflight_stats['shared']:
+                st.caption(f"Request coalescing: {singleflight_stats['shared']} groups shared an in-flight API call, {singleflight_stats['calls']} calls made.")
+
+            parse_stats = summary.get('parse_cache')
+            if parse_stats:
+                st.caption(f"Parse cache: {parse_stats['hits']} hits, {parse_stats['misses']} misses, {parse_stats['entries']} entries.")
+
+            db_stats = summary.get('database')
+            if db_stats and db_stats['checkouts']:
+                st.caption(f"Database pool: {db_stats['checkouts']} checkouts, {db_stats['connections_opened']} new connections, average wait {db_stats['avg_checkout_wait'] * 1000:.1f} ms (max {db_stats['checkout_wait_max'] * 1000:.0f} ms, {db_stats['slow_checkouts']} over 100 ms), {db_stats['reconnects']} tunnel reconnects.")
+            if db_stats and db_stats.get('queries'):
+                with st.expander(f"Database queries ({sum(q['calls'] for q in db_stats['queries'])} calls, {sum(q['total'] for q in db_stats['queries']):.2f} s)"):
+                    queries_df = pd.DataFrame(db_stats['queries'])
+                    queries_df["avg"] = queries_df["total"] / queries_df["calls"]
+                    st.dataframe(queries_df[["shape", "calls", "errors", "total", "avg", "max", "checkout", "execute", "fetch", "build", "rows", "bytes"]], hide_index=True)
+                    if db_stats['slow_queries']:
+                        st.markdown(f"**Slow queries (over {db_utils.SLOW_QUERY_SECONDS:.1f} s)**")
+                        st.dataframe(pd.DataFrame(db_stats['slow_queries']).drop(columns=["time"]), hide_index=True)
+
+            writer_stats = summary.get('run', {}).get('writer')
+            if writer_stats and writer_stats['submitted']:
+                st.caption(f"Database writes: {writer_stats['written']} written in {writer_stats['batches']} batches.")
+                if writer_stats['failed']:
+                    st.error(f"{writer_stats['failed']} database writes failed and were recorded in '{WRITER_FAILURE_REPORT_PATH}'.")
+
+            pipeline_stats = summary.get('run', {}).get('pipeline')
+            if pipeline_stats:
+                bottleneck = max(pipeline_stats, key=lambda name: pipeline_stats[name]['utilization'])
+                with st.expander(f"Pipeline stages (busiest: {bottleneck})"):
+                    stages_df = pd.DataFrame.from_dict(pipeline_stats, orient="index")
+                    st.dataframe(stages_df[["workers", "processed", "throughput", "peak_depth", "avg_wait", "avg_busy", "utilization"]])
+
+            hedge_stats = summary.get('run', {}).get('hedging')
+            if hedge_stats and hedge_stats['enabled']:
+                st.caption(f"Hedging: {hedge_stats['hedges']} duplicate requests issued for {hedge_stats['requests']} requests, {hedge_stats['hedge_wins']} won by the duplicate.")
+
+            limiter_stats = summary.get('limiter')
+            if limiter_stats:
+                with st.expander(f"Adaptive concurrency (current limit: {limiter_stats['limit']})"):
+                    history_df = pd.DataFrame(limiter_stats['history'], columns=["time", "limit", "reason"])
+                    if not history_df.empty:
+                        history_df["seconds"] = history_df["time"] - summary.get('start_time', history_df["time"].iloc[0])
+                        st.line_chart(history_df, x="seconds", y="limit")
+                        st.dataframe(history_df[["seconds", "limit", "reason"]], hide_index=True)
+
             st.markdown("---") # Add a separator
 
             if summary['failed_count'] > 0:
@@ -183,6 +320,30 @@ def main():
             # Create a row_id column for grouping
             results_df['row_id'] = results_df['id'].str.split('-').str[0]
             
+            # Load the stored outputs of the failed rows being shown, in one query
+            missing_ids = [r['id'] for r in st.session_state.analysis_results if r.get('failed') and 'data' in r and r['id'] not in st.session_state.old_outputs]
+            if missing_ids:
+                st.session_state.old_outputs.update(fetch_old_outputs(missing_ids))
+
+            # Bulk review: add the new results of several groups as alternatives in one statement
+            reviewable = {r['id'].split('-')[0]: r for r in st.session_state.analysis_results if r.get('failed') and 'data' in r}
+            if reviewable:
+                selected_groups = st.multiselect("Add the new results of these groups as alternatives:", sorted(reviewable))
+                if selected_groups and st.button(f"Add {len(selected_groups)} as alternatives"):
+                    items = [(row_id, {
+                        'ner_output': reviewable[row_id]['data']['new_ner_raw'],
+                        'search_list_chain_output': reviewable[row_id]['data']['new_search_raw'],
+                        'final_output': reviewable[row_id]['data']['new_final_raw']
+                    }) for row_id in selected_groups]
+                    inserted = db_utils.add_full_alternative_records(items)
+                    corpus_snapshot.mark_own_write()
+                    if inserted < 0:
+                        st.error("Could not add the selected alternatives. Check the logs for details.")
+                    else:
+                        st.toast(f"Added {inserted} alternatives and removed their groups from view.", icon="✅")
+                        st.session_state.analysis_results = [r for r in st.session_state.analysis_results if r['id'].split('-')[0] not in selected_groups]
+                        st.rerun()
+
             # Group by the new row_id
             grouped_results = results_df.groupby('row_id')
 
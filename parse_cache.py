@@ -0,0 +1,52 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from settings import get_setting
+
+PARSE_CACHE_SIZE = get_setting("PARSE_CACHE_SIZE", 20000)
+
+def clone_parsed(value):
+    """Copies the dict/list skeleton of a parsed value so callers can mutate it freely."""
+    if isinstance(value, dict):
+        return {k: clone_parsed(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [clone_parsed(v) for v in value]
+    return value
+
+class ParseCache:
+    """
+    Bounded LRU of parsed outputs keyed by (parser kind, content hash).
+    Callers always get their own copy of the cached value.
+    """
+
+    def __init__(self, max_entries=PARSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_parse(self, kind, text, parser):
+        key = (kind, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return clone_parsed(self._entries[key])
+            self.misses += 1
+
+        value = parser(text)
+        with self._lock:
+            self._entries[key] = value
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return clone_parsed(value)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+parse_cache = ParseCache()
+
+def get_parse_cache_stats():
+    return parse_cache.stats()
@@ -0,0 +1,265 @@
+import asyncio
+import os
+import time
+import threading
+import logging
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from process_row import prepare_row_group, compare_row_results, apply_row_group_writes
+from process_functions import fetch_row_results_async, fill_empty_records_async
+from helpers import update_database_record
+from corpus import build_group_records, merge_filled_rows
+from field_mapping import get_field_mapping_index
+from engine import MAX_CONCURRENCY
+from settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_QUEUE_SIZE = get_setting("PIPELINE_QUEUE_SIZE", 50)
+PIPELINE_PREPARE_WORKERS = get_setting("PIPELINE_PREPARE_WORKERS", 4)
+PIPELINE_FETCH_WORKERS = get_setting("PIPELINE_FETCH_WORKERS", MAX_CONCURRENCY)
+PIPELINE_FILL_WORKERS = get_setting("PIPELINE_FILL_WORKERS", PIPELINE_FETCH_WORKERS)
+PIPELINE_COMPARE_WORKERS = get_setting("PIPELINE_COMPARE_WORKERS", os.cpu_count() or 1)
+PIPELINE_PERSIST_WORKERS = get_setting("PIPELINE_PERSIST_WORKERS", 1)
+COMPARE_PROCESSES = get_setting("COMPARE_PROCESSES", 0)
+COMPARE_PROCESS_START_METHOD = get_setting("COMPARE_PROCESS_START_METHOD", "spawn")
+
+class _Job:
+    """One row group moving through the pipeline."""
+
+    def __init__(self, row_id, records, future):
+        self.row_id = row_id
+        self.records = records
+        self.future = future
+        self.query_type = None
+        self.api_query = None
+        self.api_results = None
+        self.writes = None
+        self.enqueued_at = None
+
+class PipelineStage:
+    """A bounded queue with its own workers, plus the counters reported for it."""
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.peak_depth = 0
+        self.started_at = time.perf_counter()
+
+    async def put(self, job):
+        job.enqueued_at = time.perf_counter()
+        await self.queue.put(job)
+        self.peak_depth = max(self.peak_depth, self.queue.qsize())
+
+    def stats(self):
+        elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "peak_depth": self.peak_depth,
+            "processed": self.processed,
+            "throughput": self.processed / elapsed,
+            "avg_wait": self.wait_seconds / self.processed if self.processed else 0.0,
+            "avg_busy": self.busy_seconds / self.processed if self.processed else 0.0,
+            "utilization": self.busy_seconds / (self.workers * elapsed),
+        }
+
+class RowGroupPipeline:
+    """
+    Runs row groups through stages joined by bounded queues: fill (API call for
+    groups with empty rows, whose records are then re-parsed with the new
+    outputs) -> prepare (duplicate checks, worker threads) -> fetch (API calls
+    on the engine loop) -> compare (parsing and comparison in a thread pool) ->
+    persist (write intents handed to the run's writer). With COMPARE_PROCESSES
+    set, compare runs in the shared process pool instead of threads.
+
+    A full queue holds back the stage in front of it, so a slow stage shows up
+    as queue depth and wait time instead of tying up API slots. Groups without
+    empty rows skip the fill stage, so they are analysed while the others are
+    still being filled. process() resolves as soon as a group is compared; its
+    writes are persisted behind it, and close() waits for them. Create and use
+    it on the engine loop, with a RunContext that has a DuplicateQueryIndex.
+    """
+
+    def __init__(self, run, use_agent_stream=False, stop_event=None, queue_size=PIPELINE_QUEUE_SIZE,
+                 fill_workers=PIPELINE_FILL_WORKERS, prepare_workers=PIPELINE_PREPARE_WORKERS, fetch_workers=PIPELINE_FETCH_WORKERS,
+                 compare_workers=PIPELINE_COMPARE_WORKERS, persist_workers=PIPELINE_PERSIST_WORKERS,
+                 compare_processes=COMPARE_PROCESSES):
+        self.run = run
+        self.use_agent_stream = use_agent_stream
+        self.stop_event = stop_event
+        self.filled = {}
+        self.deleted_groups = 0
+        if compare_processes:
+            compare_workers = compare_processes
+            self._executor = get_compare_process_pool(compare_processes)
+            self._owns_executor = False
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=compare_workers, thread_name_prefix="compare")
+            self._owns_executor = True
+        self.stages = {
+            "fill": PipelineStage("fill", fill_workers, queue_size),
+            "prepare": PipelineStage("prepare", prepare_workers, queue_size),
+            "fetch": PipelineStage("fetch", fetch_workers, queue_size),
+            "compare": PipelineStage("compare", compare_workers, queue_size),
+            "persist": PipelineStage("persist", persist_workers, queue_size),
+        }
+        handlers = {"fill": self._fill, "prepare": self._prepare, "fetch": self._fetch, "compare": self._compare, "persist": self._persist}
+        self._tasks = [
+            asyncio.create_task(self._worker(stage, handlers[name]))
+            for name, stage in self.stages.items()
+            for _ in range(stage.workers)
+        ]
+
+    async def process(self, row_id, records):
+        """Runs one row group through the pipeline and returns (failed_results, latency)."""
+        future = asyncio.get_running_loop().create_future()
+        first_stage = "fill" if any(record['needs_fill'] for record in records) else "prepare"
+        await self.stages[first_stage].put(_Job(row_id, records, future))
+        return await future
+
+    async def _worker(self, stage, handler):
+        while True:
+            job = await stage.queue.get()
+            next_stage = None
+            try:
+                if job.future.cancelled() and job.writes is None:
+                    continue
+                started = time.perf_counter()
+                stage.wait_seconds += started - job.enqueued_at
+                try:
+                    next_stage = await handler(job)
+                except Exception as e:
+                    if job.future.done():
+                        logger.exception(f"Pipeline stage '{stage.name}' failed for group '{job.row_id}'")
+                    else:
+                        job.future.set_exception(e)
+                finally:
+                    stage.busy_seconds += time.perf_counter() - started
+                    stage.processed += 1
+                # Hand over before task_done() so close() never sees a job between stages.
+                if next_stage is not None:
+                    await self.stages[next_stage].put(job)
+            finally:
+                stage.queue.task_done()
+
+    async def _fill(self, job):
+        if self.stop_event and self.stop_event.is_set():
+            job.future.set_result(([], 0))
+            return None
+        filled = await self._call_api(job, fill_empty_records_async(job.records, self.stop_event, self.run))
+        if filled is None:
+            return None
+        ids, updates = filled
+        if ids:
+            job.records = await asyncio.to_thread(self._apply_fill, job, ids, updates)
+        return "prepare"
+
+    def _apply_fill(self, job, ids, updates):
+        """Writes a group's fill and returns its records re-parsed with the new outputs."""
+        update_database_record(ids, updates, self.run.writer)
+        fills = {record_id: updates for record_id in ids}
+        self.filled.update(fills)
+        if updates['ner_output'] is not None:
+            for record_id in ids:
+                self.run.duplicate_index.mark_ground_truth(job.records[0]['user_query'], record_id)
+        return build_group_records(merge_filled_rows(pd.DataFrame(job.records), fills))[job.row_id]
+
+    async def _prepare(self, job):
+        if self.stop_event and self.stop_event.is_set():
+            job.future.set_result(([], 0))
+            return None
+        early_result, job.api_query, job.query_type = await asyncio.to_thread(
+            prepare_row_group, job.row_id, job.records, self.use_agent_stream, self.run.duplicate_index, self.run.writer
+        )
+        if early_result is not None:
+            if any(result.get('status') == 'deleted_duplicate' for result in early_result[0]):
+                self.deleted_groups += 1
+            job.future.set_result(early_result)
+            return None
+        return "fetch"
+
+    async def _fetch(self, job):
+        job.api_results = await self._call_api(job, fetch_row_results_async(job.api_query, job.query_type, self.use_agent_stream, self.stop_event, self.run))
+        return "compare" if job.api_results is not None else None
+
+    async def _call_api(self, job, coro):
+        """
+        Awaits an API call for the job and returns its result, or None when the
+        job was cancelled. Cancelling the group's future aborts the call, and the
+        worker moves on.
+        """
+        self.run.active_groups.add(job.row_id)
+        job.future.add_done_callback(lambda _: self.run.active_groups.discard(job.row_id))
+        call = asyncio.ensure_future(coro)
+        job.future.add_done_callback(lambda _: call.cancel())
+        await asyncio.wait({call})
+        if call.cancelled():
+            return None
+        return call.result()
+
+    async def _compare(self, job):
+        loop = asyncio.get_running_loop()
+        failed_results, latency, job.writes = await loop.run_in_executor(
+            self._executor, compare_row_results, job.row_id, job.records, job.query_type, job.api_results, self.use_agent_stream
+        )
+        if not job.future.done():
+            job.future.set_result((failed_results, latency))
+        return "persist" if job.writes else None
+
+    async def _persist(self, job):
+        await asyncio.to_thread(apply_row_group_writes, job.writes, self.run.duplicate_index, self.run.writer)
+        return None
+
+    def queue_depths(self):
+        return {name: stage.queue.qsize() for name, stage in self.stages.items()}
+
+    def stats(self):
+        return {name: stage.stats() for name, stage in self.stages.items()}
+
+    async def close(self):
+        """Waits for the comparisons and writes still queued, then stops the workers."""
+        await self.stages["compare"].queue.join()
+        await self.stages["persist"].queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+def start_pipeline(engine, run, use_agent_stream=False, stop_event=None):
+    """Creates a RowGroupPipeline on the engine loop and attaches it to the run."""
+    async def _create():
+        return RowGroupPipeline(run, use_agent_stream, stop_event)
+    run.pipeline = engine.run(_create())
+    return run.pipeline
+
+def _init_compare_worker():
+    """Warms a compare process: loads the field mapping before the first group arrives."""
+    get_field_mapping_index()
+
+_compare_pool = None
+_compare_pool_lock = threading.Lock()
+
+def get_compare_process_pool(processes=COMPARE_PROCESSES):
+    """
+    Returns the process-wide pool for the compare stage, starting it on first use.
+    It outlives single runs so its workers stay warm. Groups are sent to it as
+    plain record dicts and raw API results, and come back as result dicts.
+    """
+    global _compare_pool
+    with _compare_pool_lock:
+        # A pool whose worker died stays broken, so replace it rather than fail every later run.
+        if _compare_pool is None or _compare_pool._broken:
+            logger.info(f"Starting compare process pool with {processes} processes...")
+            _compare_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context(COMPARE_PROCESS_START_METHOD),
+                initializer=_init_compare_worker,
+            )
+        return _compare_pool
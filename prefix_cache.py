@@ -0,0 +1,69 @@
+import asyncio
+
+class _PrefixNode:
+    __slots__ = ("children", "future")
+
+    def __init__(self):
+        self.children = {}
+        self.future = None
+
+class _TurnAborted(Exception):
+    """Set on a shared turn when the task that was fetching it got cancelled."""
+
+class ConversationPrefixCache:
+    """
+    Run-scoped trie of conversation turns. Each path from the root is a sequence
+    of query lines, and each node holds the /invoke response for that turn. The
+    history sent with a turn is built only from the responses on its path, so the
+    path identifies the (line, history) sequence. Conversations that share opening
+    turns reuse those responses, and concurrent groups asking for the same turn
+    wait on one in-flight call.
+    """
+
+    def __init__(self):
+        self._roots = {}
+        self.hits = 0
+        self.misses = 0
+
+    def root(self, endpoint):
+        node = self._roots.get(endpoint)
+        if node is None:
+            node = self._roots[endpoint] = _PrefixNode()
+        return node
+
+    async def fetch_turn(self, node, line, fetch):
+        """
+        Returns (child_node, response) for the turn `line` following `node`.
+        fetch() is only awaited when that turn is neither cached nor in flight.
+        """
+        child = node.children.get(line)
+        if child is None:
+            child = node.children[line] = _PrefixNode()
+
+        while child.future is not None:
+            try:
+                response = await asyncio.shield(child.future)
+                self.hits += 1
+                return child, response
+            except _TurnAborted:
+                continue
+
+        self.misses += 1
+        future = child.future = asyncio.get_running_loop().create_future()
+        try:
+            response = await fetch()
+        except Exception as e:
+            child.future = None
+            future.set_exception(e)
+            future.exception()
+            raise
+        except BaseException:
+            child.future = None
+            future.set_exception(_TurnAborted())
+            future.exception()
+            raise
+        future.set_result(response)
+        return child, response
+
+    def stats(self):
+        return {"reused_turns": self.hits, "fetched_turns": self.misses}
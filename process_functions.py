@@ -1,15 +1,13 @@
 from helpers import *
 from streams import *
 
-def process_convo_row(api_query, index, user_query, old_ner, old_ner_intent, use_agent_stream=False, stop_event=None):
+def parse_convo_row_results(api_results, old_ner_intent):
+        """Derives the comparison fields from the raw results of a conversational API call."""
         new_ner_intent, new_ner_search_fields, new_chain_field_values, new_ner_date_filter= "", "", "", ""
-        new_ner_raw, new_search_raw, new_final_raw , new_ner, new_search, new_final, new_time_stamp = "", "", "", "", "", "", ""
+        new_ner, new_search, new_final = "", "", ""
         new_ner_leaf_entities = ""
 
-        if use_agent_stream:
-            new_ner_raw, new_final_raw, new_search_raw, new_time_stamp, latency = get_api_results_from_agent_stream(api_query, stop_event)
-        else:
-            new_ner_raw, new_final_raw, new_search_raw, new_time_stamp, latency = get_api_results_from_conversational_stream(api_query, stop_event)
+        new_ner_raw, new_final_raw, new_search_raw, new_time_stamp, latency = api_results
 
         new_ner = new_ner_raw
         if new_ner and isinstance(new_ner, dict):
@@ -43,15 +41,13 @@ def process_convo_row(api_query, index, user_query, old_ner, old_ner_intent, use
 
         return new_ner_raw, new_search_raw, new_final_raw , new_ner, new_search, new_final, new_time_stamp, new_ner_intent, new_ner_search_fields, new_ner_leaf_entities, new_ner_date_filter, new_chain_field_values, latency
 
-def process_single_row(api_query, index, user_query, old_ner, old_ner_intent, use_agent_stream=False,stop_event=None):
+def parse_single_row_results(api_results, old_ner_intent, use_agent_stream=False):
+    """Derives the comparison fields from the raw results of a single-query API call."""
     new_ner_intent, new_ner_search_fields, new_chain_field_values, new_ner_date_filter= "", "", "", ""
-    new_ner_raw, new_search_raw, new_final_raw , new_ner, new_search, new_final, new_time_stamp = "", "", "", "", "", "", ""
+    new_ner, new_search, new_final = "", "", ""
     new_ner_leaf_entities = ""
 
-    if use_agent_stream:
-        new_ner_raw, new_final_raw, new_search_raw, new_time_stamp, latency = get_api_results_from_agent_stream(api_query, stop_event)
-    else:
-        new_ner_raw, new_final_raw, new_search_raw, new_time_stamp, latency = get_api_results_from_stream(api_query, stop_event)    
+    new_ner_raw, new_final_raw, new_search_raw, new_time_stamp, latency = api_results
 
     if use_agent_stream:
         new_ner = new_ner_raw 
@@ -87,52 +83,47 @@ def process_single_row(api_query, index, user_query, old_ner, old_ner_intent, us
 
     return new_ner_raw, new_search_raw, new_final_raw , new_ner, new_search, new_final, new_time_stamp, new_ner_intent, new_ner_search_fields, new_ner_leaf_entities, new_ner_date_filter, new_chain_field_values, latency
 
-def fill_empty_row_group(group_df):
+async def fetch_row_results_async(api_query, query_type, use_agent_stream, stop_event, run):
     """
-    Processes a group of rows with empty ner_output.
-    Makes one API call and updates all rows in the group with the result.
+    Makes the API call for one group and returns the raw, unparsed api_results.
+    Within a run, groups with the same endpoint and api_query share one call.
     """
-    base_row = group_df.iloc[0]
-    user_query = base_row.get('user_query', "")
-    if not user_query:
-        return
-
-    api_query = user_query
-    query_type = "single"
-    if '\n' in user_query.strip():
-        query_type = "conversational"
-        if '1.' not in user_query.strip() : 
-            lines = user_query.strip().split('\n')
-            formatted_lines = [f"{i}. {line.strip()}" for i, line in enumerate(lines, 1) if line.strip()]
-            api_query = "\n".join(formatted_lines)
-        else :
-            lines = user_query.strip().split('\n')
-            formatted_lines = []
-            for line in lines:
-                clean_line = line.strip()
-                if clean_line:
-                    parts = clean_line.split('.', 1)
-                    if len(parts) == 2:
-                        formatted_lines.append(parts[0].strip() + '.' + parts[1].lstrip())
-                    else:
-                        formatted_lines.append(clean_line)
-            api_query = "\n".join(formatted_lines)
-
-    new_ner_raw, new_final_raw, new_search_raw, time_stamp = "", "", "", ""
-    if query_type == "conversational":
-        new_ner_raw, new_final_raw, new_search_raw, time_stamp, _ = get_api_results_from_conversational_stream(api_query)
+    if use_agent_stream:
+        endpoint, fetch = "/agent/invoke", get_api_results_from_agent_stream_async
+    elif query_type == "conversational":
+        endpoint, fetch = "/invoke", get_api_results_from_conversational_stream_async
     else:
-        new_ner_raw, new_final_raw, new_search_raw, time_stamp, _ = get_api_results_from_stream(api_query)
+        endpoint, fetch = "/stream", get_api_results_from_stream_async
+    return await run.singleflight.do((endpoint, api_query), lambda: fetch(api_query, stop_event, run))
 
-    updates = {
+def parse_row_results(api_results, query_type, use_agent_stream=False):
+    """Parses raw api_results from fetch_row_results_async with the parser for the query type."""
+    if query_type == "conversational":
+        return parse_convo_row_results(api_results, None)
+    return parse_single_row_results(api_results, None, use_agent_stream)
+
+async def fill_empty_records_async(records, stop_event, run):
+    """
+    Fills a group's empty rows: one API call for the query, shared with any
+    identical call in flight. Returns (ids, updates) for the records that need
+    filling and leaves writing them to the caller.
+    """
+    user_query = records[0].get('user_query', "")
+    if not user_query:
+        return [], None
+    api_query, query_type = normalize_api_query(user_query)
+    api_results = await fetch_row_results_async(api_query, query_type, False, stop_event, run)
+    if stop_event and stop_event.is_set():
+        return [], None
+    return [record['id'] for record in records if record['needs_fill']], build_fill_updates(api_results, query_type)
+
+def build_fill_updates(api_results, query_type):
+    """Column updates that store fresh API results in an empty row."""
+    new_ner_raw, new_final_raw, new_search_raw, time_stamp, _ = api_results
+    return {
         'ner_output': json.dumps(new_ner_raw) if isinstance(new_ner_raw, (dict, list)) else new_ner_raw,
         'search_list_chain_output': json.dumps(new_search_raw) if isinstance(new_search_raw, (dict, list)) else new_search_raw,
         'final_output': json.dumps(new_final_raw) if isinstance(new_final_raw, (dict, list)) else new_final_raw,
         'query_type': query_type,
         'time_stamp':time_stamp
     }
-
-    current_ids = group_df['id'].tolist()
-    update_database_record(current_ids, updates)
-
-    
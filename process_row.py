@@ -1,93 +1,78 @@
 from process_functions import *
-import pandas as pd
 
-def process_row_group(row_id, group_df, use_agent_stream=False, stop_event=None):
-
-    if stop_event and stop_event.is_set():
-        return [], 0
-
-    latency = 0
-    new_ner_intent, new_ner_search_fields, new_chain_field_values, new_ner_date_filter= "", "", "", ""
-    new_ner_raw, new_search_raw, new_final_raw , new_ner, new_search, new_final, new_time_stamp = "", "", "", "", "", "", ""
+def prepare_row_group(row_id, records, use_agent_stream, duplicate_index, writer=None):
     """
-    Processes a group of rows (alternatives) for a single user_query.
-    Makes one API call and compares the result against each alternative.
+    Runs the checks that decide whether a group needs an API call at all.
+    `records` are the group's pre-parsed rows from corpus.build_group_records.
+    The duplicate checks run in memory against the run's DuplicateQueryIndex, and
+    with a WriteBehindWriter the deletes are queued.
+    Returns (early_result, api_query, query_type); when early_result is not None
+    the group is already finished and early_result is its (results, latency).
     """
     # Use the first row in the group to get the user_query and determine query type
-    base_row = group_df.iloc[0]
+    base_row = records[0]
     user_query = base_row.get('user_query', "")
     if not user_query:
-        return [], 0
+        return ([], 0), None, None
     
     if use_agent_stream:
-        old_ner_raw = base_row.get('ner_output', "")
-        old_ner = parse_csv_text_to_json(old_ner_raw) 
-        old_ner_intent = ""
-        if old_ner and isinstance(old_ner, dict):
-            old_ner_intent = old_ner.get("intent", "")
+        if base_row['ner_intent'] != ["search_list"]:
+            return ([], 0), None, None
 
-        if old_ner_intent != ["search_list"]:
-            return [], 0 
-    
-    existing_query_df = db_utils.fetch_dataframe(
-        "llm",
-        "SELECT row_id FROM `test_results` WHERE `user_query` = :user_query AND `row_id` != :current_row_id LIMIT 1",
-        params={'user_query': user_query, 'current_row_id': row_id}
-    )
+    api_query, query_type = normalize_api_query(user_query)
 
-    if existing_query_df is not None and not existing_query_df.empty:
+    duplicate_row_id = duplicate_index.claim(row_id, user_query, [record['id'] for record in records])
+
+    if duplicate_row_id is not None:
         delete_query = "DELETE FROM `test_results` WHERE `row_id` = :row_id"
-        db_utils.execute_query("llm", delete_query, params={'row_id': row_id})
-        return [{
+        execute_write(delete_query, {'row_id': row_id}, writer)
+        return ([{
             "id": f"{row_id}-0",
             "failed": False,
             "status": "deleted_duplicate",
-            "error": f"Deleted group '{row_id}': Duplicate of a query found in group '{existing_query_df.iloc[0]['row_id']}'"
-        }], 0
+            "error": f"Deleted group '{row_id}': Duplicate of a query found in group '{duplicate_row_id}'"
+        }], 0), None, None
     
-    empty_rows_in_group = group_df[pd.isnull(group_df['ner_output'])]
+    empty_rows_in_group = [record for record in records if not record['has_ner']]
 
-    if not empty_rows_in_group.empty:
-        check_query = "SELECT 1 FROM `test_results` WHERE `user_query` = :user_query AND `ner_output` IS NOT NULL LIMIT 1"
-        established_df = db_utils.fetch_dataframe("llm", check_query, params={'user_query': api_query})
-        if established_df is not None and not established_df.empty:
-            ids_to_delete = empty_rows_in_group['id'].tolist()
-            id_placeholders = ", ".join([f":id_{i}" for i in range(len(ids_to_delete))])
-            delete_query = f"DELETE FROM `test_results` WHERE `id` IN ({id_placeholders})"
-            params = {f"id_{i}": r_id for i, r_id in enumerate(ids_to_delete)}
-            db_utils.execute_query("llm", delete_query, params=params)
-            return [{
+    if empty_rows_in_group:
+        if duplicate_index.has_ground_truth(user_query):
+            ids_to_delete = [record['id'] for record in empty_rows_in_group]
+            delete_database_records(ids_to_delete, writer)
+            return ([{
                 "id": f"{row_id}-0",
                 "failed": False,
                 "status": "deleted_duplicate",
                 "error": f"Deleted {len(ids_to_delete)} empty duplicate row(s) from group '{row_id}'."
-            }], 0
-    
-    api_query = user_query
-    query_type = "single"
-    if '\n' in user_query.strip():
-        query_type = "conversational"
-        if '1.' not in user_query.strip() : 
-            lines = user_query.strip().split('\n')
-            formatted_lines = [f"{i}. {line.strip()}" for i, line in enumerate(lines, 1) if line.strip()]
-            api_query = "\n".join(formatted_lines)
-        else :
-            lines = user_query.strip().split('\n')
-            formatted_lines = []
-            for line in lines:
-                clean_line = line.strip()
-                if clean_line:
-                    parts = clean_line.split('.', 1)
-                    if len(parts) == 2:
-                        formatted_lines.append(parts[0].strip() + '.' + parts[1].lstrip())
-                    else:
-                        formatted_lines.append(clean_line)
-            api_query = "\n".join(formatted_lines)
+            }], 0), None, None
+
+    return None, api_query, query_type
+
+def compare_row_results(row_id, records, query_type, api_results, use_agent_stream=False):
+    """Parses raw api_results and evaluates them against the group, as one CPU-bound step."""
+    new_results = parse_row_results(api_results, query_type, use_agent_stream)
+    return evaluate_row_group(row_id, records, query_type, new_results)
+
+def apply_row_group_writes(writes, duplicate_index, writer=None):
+    """Applies the write intents returned by evaluate_row_group."""
+    for write in writes:
+        update_database_record(write['ids'], write['updates'], writer)
+        if write.get('ground_truth_query') is not None:
+            duplicate_index.mark_ground_truth(write['ground_truth_query'], write['ids'])
 
-    if query_type == "conversational":
-        new_ner_raw, new_search_raw, new_final_raw, new_ner, new_search, new_final, new_time_stamp, new_ner_intent, new_ner_search_fields, new_ner_leaf_entities, new_ner_date_filter, new_chain_field_values, latency = process_convo_row(api_query, row_id, user_query, None, None, use_agent_stream, stop_event)
-    else:
-        new_ner_raw, new_search_raw, new_final_raw, new_ner, new_search, new_final, new_time_stamp, new_ner_intent, new_ner_search_fields, new_ner_leaf_entities, new_ner_date_filter, new_chain_field_values, latency = process_single_row(api_query, row_id, user_query, None, None, use_agent_stream, stop_event)
+def evaluate_row_group(row_id, records, query_type, new_results):
+    """
+    Compares the fresh API results against every alternative in the group and
+    returns (failed_results, latency, writes) without touching the database.
+    `writes` are {"ids", "updates", "ground_truth_query"} intents for
+    apply_row_group_writes. The old side comes pre-parsed from the records.
+    Failed results carry no old NER/search outputs; the UI loads those lazily.
+    A group with a row whose stored outputs could not be parsed at load time
+    never passes, so that row is shown as a failure.
+    """
+    base_row = records[0]
+    user_query = base_row.get('user_query', "")
+    new_ner_raw, new_search_raw, new_final_raw, new_ner, new_search, new_final, new_time_stamp, new_ner_intent, new_ner_search_fields, new_ner_leaf_entities, new_ner_date_filter, new_chain_field_values, latency = new_results
 
     if new_ner_raw and isinstance(new_ner_raw, str) and (new_ner_raw.startswith("Conversational") or new_ner_raw.startswith("Retried")):
         return [{
@@ -96,53 +81,32 @@ def process_row_group(row_id, group_df, use_agent_stream=False, stop_event=None)
             "failed": True,
             "failures": {"ner": True, "search": False, "final": False},
             "data": {
-                "old_ner": parse_csv_text_to_json(base_row.get('ner_output', "")), "new_ner": new_ner,
-                "old_search": convert_yaml_text_to_json(base_row.get('search_list_chain_output', "")), "new_search": new_search,
-                "old_final": extract_url(base_row.get('final_output', "")), "new_final": new_final,
+                "new_ner": new_ner, "new_search": new_search,
+                "old_final": base_row['final_url'], "new_final": new_final,
                 "new_ner_raw": new_ner_raw, "new_search_raw": new_search_raw, "new_final_raw": new_final_raw
                 }
-        }], latency
+        }], latency, []
     
     if new_ner_raw and isinstance(new_ner_raw, str) and "Process stopped externally" in new_ner_raw:
-        return [], 0 
+        return [], 0, []
     
     any_match_found = False
+    has_parse_error = any(record['parse_error'] for record in records)
     comparison_results = []
+    writes = []
     
 
     # --- 2. Iterate through each alternative and compare ---
-    for _, alt_row in group_df.iterrows():
+    for alt_row in records:
         current_id = alt_row['id']
-        old_ner_raw = alt_row.get('ner_output', "")
-        old_search_raw = alt_row.get('search_list_chain_output', "")
-        old_final_raw = alt_row.get('final_output', "")
 
-        # --- Parse Old Data for this alternative ---
-        old_ner = parse_csv_text_to_json(old_ner_raw)
-        old_ner_intent, old_ner_search_fields, old_ner_leaf_entities, old_ner_date_filter = "", "", "", ""
-        if old_ner:
-            old_ner_intent = old_ner.get("intent", "")
-            old_ner_search_fields = old_ner.get("search_fields", "")
-            old_ner_leaf_entities = old_ner.get("leaf_entities", "")
-            if old_ner_search_fields:
-                old_ner_date_filter = [field.get("date_filter", "").get("value", "") for field in old_ner_search_fields if isinstance(field, dict)]
-                old_ner_search_fields = [field for field in old_ner_search_fields if not isinstance(field, dict)]
-
-        old_search = convert_yaml_text_to_json(old_search_raw)
-        if old_search and "feedback_message" in old_search:
-            old_search.pop("feedback_message")
-
-        old_chain_field_values = ""
-        if old_search:
-            old_chain_search_fields = old_search.get("search_fields", "")
-            old_chain_field_values = [item.get("field_value", "") for item in old_chain_search_fields if item.get("field_type", "") != "date"]
-        
-        if isinstance(old_final_raw, dict) :
-            old_final = old_final_raw['url']
-        elif old_final_raw :
-            old_final = extract_url(old_final_raw)
-        else:
-            old_final = ""
+        # --- Old data for this alternative, parsed once at load time ---
+        old_ner_intent = alt_row['ner_intent']
+        old_ner_search_fields = alt_row['ner_search_fields']
+        old_ner_leaf_entities = alt_row['ner_leaf_entities']
+        old_ner_date_filter = alt_row['ner_date_filter']
+        old_chain_field_values = alt_row['chain_field_values']
+        old_final = alt_row['final_url']
 
         # --- Perform Comparison Logic ---
         ner_flag, search_flag, final_flag, date_flag = False, False, False, False
@@ -174,20 +138,26 @@ def process_row_group(row_id, group_df, use_agent_stream=False, stop_event=None)
             ner_flag = False
             search_flag = False
 
-        is_new_row = (pd.isnull(old_ner_raw) or old_ner_raw == "") and \
-                     (pd.isnull(old_search_raw) or old_search_raw == "") and \
-                     (pd.isnull(old_final_raw) or old_final_raw == "")
-
-        if is_new_row:
+        if alt_row['is_new_row']:
             updates = {
                 'ner_output': json.dumps(new_ner_raw) if isinstance(new_ner_raw, (dict, list)) else new_ner_raw,
                 'search_list_chain_output': json.dumps(new_search_raw) if isinstance(new_search_raw, (dict, list)) else new_search_raw,
                 'final_output': json.dumps(new_final_raw) if isinstance(new_final_raw, (dict, list)) else new_final_raw,
                 'query_type': query_type
             }
-            update_database_record(current_id, updates)
+            writes.append({
+                "ids": current_id,
+                "updates": updates,
+                "ground_truth_query": user_query if updates['ner_output'] is not None else None
+            })
             ner_flag, search_flag, final_flag = False, False, False
             is_failure = False
+
+        if alt_row['parse_error']:
+            ner_flag = ner_flag or 'ner_output' in alt_row['parse_error']
+            search_flag = search_flag or 'search_list_chain_output' in alt_row['parse_error']
+            final_flag = final_flag or 'final_output' in alt_row['parse_error']
+            is_failure = True
     
 
         print(f"\n--- Row ID: {current_id} ---")
@@ -220,7 +190,7 @@ def process_row_group(row_id, group_df, use_agent_stream=False, stop_event=None)
         # print(f"similarity between refs : {(calculate_similarity(ref_old_ner_search_fields, ref_new_ner_search_fields))}")
         # print(f"similarity between norm : {(calculate_similarity(old_ner_search_fields, new_ner_search_fields))}")
         
-        if not is_failure:
+        if not is_failure and not has_parse_error:
             any_match_found = True
             break
 
@@ -231,17 +201,17 @@ def process_row_group(row_id, group_df, use_agent_stream=False, stop_event=None)
             "final_flag": final_flag
         })
             
-    update_database_record(
-        group_df['id'].tolist(), 
-        {'time_stamp': new_time_stamp}
-    )
+    writes.append({
+        "ids": [record['id'] for record in records],
+        "updates": {'time_stamp': new_time_stamp}
+    })
     # If no match was found after checking all alternatives, the group has failed.
     if not any_match_found:
         failed_results = []
         # Use the recorded comparison results to build the final output
         for result in comparison_results:
             # Get the original row data corresponding to this result
-            alt_row = group_df[group_df['id'] == result['id']].iloc[0]
+            alt_row = next(record for record in records if record['id'] == result['id'])
             
             failed_results.append({
                 "id": result['id'],
@@ -253,13 +223,13 @@ def process_row_group(row_id, group_df, use_agent_stream=False, stop_event=None)
                     "final": result['final_flag']
                 },
                 "data": {
-                    "old_ner": parse_csv_text_to_json(alt_row.get('ner_output', "")), "new_ner": new_ner,
-                    "old_search": convert_yaml_text_to_json(alt_row.get('search_list_chain_output', "")), "new_search": new_search,
-                    "old_final": extract_url(alt_row.get('final_output', "")), "new_final": new_final,
-                    "new_ner_raw": new_ner_raw, "new_search_raw": new_search_raw, "new_final_raw": new_final_raw
+                    "new_ner": new_ner, "new_search": new_search,
+                    "old_final": alt_row['final_url'], "new_final": new_final,
+                    "new_ner_raw": new_ner_raw, "new_search_raw": new_search_raw, "new_final_raw": new_final_raw,
+                    "parse_error": alt_row['parse_error']
                 }
             })
-        return failed_results, latency
+        return failed_results, latency, writes
 
     # Otherwise, a match was found, and the group passes.
-    return [], latency
+    return [], latency, writes
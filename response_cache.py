@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import logging
+from settings import get_setting
+from helpers import normalize_api_query
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_MODE = get_setting("RESPONSE_CACHE_MODE", "off")
+RESPONSE_CACHE_PATH = get_setting("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+RESPONSE_CACHE_TTL = get_setting("RESPONSE_CACHE_TTL", 7 * 24 * 3600)
+RESPONSE_CACHE_MAX_ENTRIES = get_setting("RESPONSE_CACHE_MAX_ENTRIES", 50000)
+BACKEND_VERSION = get_setting("BACKEND_VERSION", "default")
+
+class ResponseCacheMiss(Exception):
+    """Raised in replay mode when a request has no recorded response."""
+
+class ResponseCache:
+    """
+    Content-addressed store of raw API responses in a local SQLite file.
+    Entries older than the TTL are ignored and pruned, and the least recently
+    used entries are evicted once the store grows past max_entries.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._puts_since_evict = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, endpoint TEXT, backend_version TEXT, "
+            "response TEXT, created_at REAL, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and row[1] < now - self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, endpoint, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, endpoint, backend_version, response, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, endpoint, BACKEND_VERSION, json.dumps(response), now, now),
+            )
+            self._conn.commit()
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= 100:
+                self._puts_since_evict = 0
+                self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        self._conn.commit()
+
+def make_cache_key(endpoint, api_query, history=None):
+    """Hashes the endpoint, normalized query, conversation history and backend version."""
+    normalized_query = normalize_api_query(api_query)[0]
+    material = json.dumps([endpoint, normalized_query, history or [], BACKEND_VERSION], sort_keys=True, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            logger.info(f"Opening response cache at '{RESPONSE_CACHE_PATH}' in {RESPONSE_CACHE_MODE} mode...")
+            _cache = ResponseCache()
+        return _cache
+
+async def cached_request(endpoint, payload, fetch):
+    """
+    Runs fetch() through the response cache. In "record" mode the response is
+    fetched and stored, in "replay" mode it is served from the cache without
+    touching the network, and in "off" mode the cache is bypassed.
+    """
+    if RESPONSE_CACHE_MODE not in ("record", "replay"):
+        return await fetch()
+
+    key = make_cache_key(endpoint, payload.get("query", ""), payload.get("conversation_history"))
+    cache = get_response_cache()
+
+    if RESPONSE_CACHE_MODE == "replay":
+        response = await asyncio.to_thread(cache.get, key)
+        if response is None:
+            raise ResponseCacheMiss(f"No recorded response for {endpoint} query: {payload.get('query', '')!r}")
+        return response
+
+    response = await fetch()
+    await asyncio.to_thread(cache.put, key, endpoint, response)
+    return response
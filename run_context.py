@@ -0,0 +1,23 @@
+from prefix_cache import ConversationPrefixCache
+from hedging import HedgePolicy
+from singleflight import SingleFlight
+
+class RunContext:
+    """State shared by every row group of a single analysis run."""
+
+    def __init__(self, duplicate_index=None, writer=None):
+        self.duplicate_index = duplicate_index
+        self.writer = writer
+        self.prefix_cache = ConversationPrefixCache()
+        self.hedging = HedgePolicy()
+        self.singleflight = SingleFlight()
+        self.active_groups = set()
+        self.pipeline = None
+
+    def stats(self):
+        stats = {"prefix_cache": self.prefix_cache.stats(), "hedging": self.hedging.stats(), "singleflight": self.singleflight.stats()}
+        if self.writer is not None:
+            stats["writer"] = self.writer.stats()
+        if self.pipeline is not None:
+            stats["pipeline"] = self.pipeline.stats()
+        return stats
@@ -0,0 +1,22 @@
+import os
+import streamlit as st
+
+def get_setting(name, default=None):
+    """
+    Reads a configuration value from st.secrets, falling back to the environment
+    and then to the given default. Values are cast to the type of the default.
+    """
+    try:
+        value = st.secrets[name]
+    except Exception:
+        value = os.environ.get(name)
+
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value if isinstance(value, bool) else str(value).strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
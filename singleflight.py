@@ -0,0 +1,53 @@
+import asyncio
+from parse_cache import clone_parsed
+
+class _CallAborted(Exception):
+    """Set on a shared call when the task that was making it got cancelled."""
+
+class SingleFlight:
+    """
+    Run-scoped coalescing of identical API calls. While a call for a key is in
+    flight, every other caller with the same key waits on it instead of making its
+    own, and gets its own copy of the result. Keys are forgotten once the call
+    finishes; repeats after that are left to the response cache.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fetch):
+        """Returns fetch()'s result, awaiting fetch() only when no call for `key` is in flight."""
+        while key in self._calls:
+            try:
+                result = await asyncio.shield(self._calls[key])
+                self.shared += 1
+                return _clone_result(result)
+            except _CallAborted:
+                continue
+
+        self.calls += 1
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fetch()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        except BaseException:
+            future.set_exception(_CallAborted())
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+        future.set_result(result)
+        return _clone_result(result)
+
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared}
+
+def _clone_result(result):
+    if isinstance(result, tuple):
+        return tuple(clone_parsed(value) for value in result)
+    return clone_parsed(result)
@@ -0,0 +1,51 @@
+import sqlite3
+from sqlalchemy import create_engine, event
+
+# Mirrors the MySQL test_results table. id is derived from row_id and alt_id,
+# as it is on the server, so inserts never supply it.
+TEST_RESULTS_DDL = """
+CREATE TABLE IF NOT EXISTS test_results (
+    id TEXT GENERATED ALWAYS AS (row_id || '-' || alt_id) STORED,
+    row_id TEXT NOT NULL,
+    alt_id INTEGER NOT NULL DEFAULT 0,
+    user_query TEXT,
+    query_type TEXT,
+    ner_output TEXT,
+    search_list_chain_output TEXT,
+    final_output TEXT,
+    time_stamp TEXT,
+    UNIQUE (row_id, alt_id)
+)
+"""
+
+TEST_RESULTS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_test_results_id ON test_results(id)",
+    "CREATE INDEX IF NOT EXISTS idx_test_results_user_query ON test_results(user_query)",
+    "CREATE INDEX IF NOT EXISTS idx_test_results_time_stamp ON test_results(time_stamp)",
+]
+
+def create_test_results_table(conn, extra_columns=()):
+    """
+    Creates the test_results table on a sqlite3 connection. Columns present in
+    the source table but not in the mirrored schema are added as TEXT.
+    """
+    conn.execute(TEST_RESULTS_DDL)
+    existing = {row[1] for row in conn.execute("PRAGMA table_xinfo(test_results)")}
+    for col in extra_columns:
+        if col not in existing:
+            conn.execute(f'ALTER TABLE test_results ADD COLUMN "{col}" TEXT')
+    for statement in TEST_RESULTS_INDEXES:
+        conn.execute(statement)
+
+def create_sqlite_engine(path):
+    """SQLAlchemy engine on a local SQLite file holding the test_results schema."""
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+        dbapi_connection.execute("PRAGMA busy_timeout=5000")
+
+    with sqlite3.connect(path) as conn:
+        create_test_results_table(conn)
+    return engine
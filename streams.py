@@ -1,39 +1,78 @@
 from helpers import *
-import json, datetime, time, requests
+from transport import get_session
+from response_cache import cached_request, ResponseCacheMiss
+from limiter import get_limiter
+from settings import get_setting
+import json, datetime, time, asyncio, aiohttp, logging
 
-def get_api_results_from_conversational_stream(query_text,stop_event=None):
+logger = logging.getLogger(__name__)
+
+API_BASE_URL = "https://aitest.ebalina.com"
+# ValueError covers a 200 response whose body is not JSON, such as a proxy error page.
+API_ERRORS = (aiohttp.ClientError, aiohttp.ContentTypeError, ValueError, asyncio.TimeoutError, ResponseCacheMiss)
+
+NER_EVENT_MARKER = b"NER Succeded"
+SEARCH_EVENT_MARKER = b"Search List Result"
+OUTPUT_EVENT_MARKER = b'"output"'
+EVENT_MARKERS = (NER_EVENT_MARKER, SEARCH_EVENT_MARKER, OUTPUT_EVENT_MARKER)
+
+SSE_MAX_LINE_BYTES = get_setting("SSE_MAX_LINE_BYTES", 1024 * 1024)
+SSE_CHUNK_BYTES = 64 * 1024
+
+async def _hedged(endpoint, fetch, run):
+    # A hedge duplicate shares its primary's limiter slot, so queueing time never
+    # counts towards the hedge threshold; HEDGE_BUDGET bounds the extra load.
+    async with get_limiter().slot():
+        return await run.hedging.call(endpoint, fetch)
+
+async def _post_json(endpoint, payload, run):
+    async def fetch():
+        session = await get_session()
+        async with session.post(API_BASE_URL + endpoint, json=payload) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+    return await cached_request(endpoint, payload, lambda: _hedged(endpoint, fetch, run))
+
+async def _post_stream(payload, run):
+    async def fetch():
+        session = await get_session()
+        async with session.post(API_BASE_URL + "/stream", json=payload) as response:
+            response.raise_for_status()
+            return list(await _read_stream_events(response))
+    return await cached_request("/stream", payload, lambda: _hedged("/stream", fetch, run))
+
+async def _get_conversation_results_async(query_text, endpoint, label, stop_event, run, keep_dict_ner=False):
     history = []
+    prefix_node = run.prefix_cache.root(endpoint)
     lines = [line.strip() for line in query_text.split('\n') if line.strip()]
     final_response_data = None
-    
-    inverse_map = create_inverse_field_map(reconstructed_search_mapping)
+
+    field_index = get_field_mapping_index()
     start_time= time.time()
     max_retries = 1
     last_error = "API call returned no error"
 
     if stop_event and stop_event.is_set():
         return "Process stopped externally before starting.", "","", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
-    
+
     for i, line in enumerate(lines):
         if stop_event and stop_event.is_set():
             error_message = f"Process stopped externally after {i} steps."
             return error_message, error_message, error_message, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
-        
+
         payload = {"query": line, "conversation_history": history, "trace": "false"}
         for attempt in range(max_retries):
             try:
-                print(f"convo attempt : {attempt+1} for line : {line}")
-                response = requests.post("https://aitest.ebalina.com/invoke", json=payload, timeout=50)
-                response.raise_for_status()
-                data = response.json()   
+                print(f"{label} attempt : {attempt+1} for line : {line}")
+                prefix_node, data = await run.prefix_cache.fetch_turn(prefix_node, line, lambda: _post_json(endpoint, payload, run))
                 if "ner_output" in data:
                     history.append({"user": line, "ai": data["ner_output"]})
                 if i == len(lines) - 1:
                     final_response_data = data
-                break 
-            except requests.exceptions.RequestException as e:
+                break
+            except API_ERRORS as e:
                 last_error = e
-                time.sleep(1) 
+                await asyncio.sleep(1)
         else:
             error_message = f"Retried {max_retries} times but API call failed for line: '{line}'."
             if last_error:
@@ -48,69 +87,150 @@ def get_api_results_from_conversational_stream(query_text,stop_event=None):
         final_output_raw = final_response_data.get("output", {})
         search_output_raw = ""
         ner_as_json = ""
-        
+
         url_to_process = final_output_raw.get("url")
-        
+
         if url_to_process:
-            ner_as_json = convert_yaml_text_to_json(ner_output_raw)
-            search_list_chain_output = reverse_engineer_search_output(url_to_process, inverse_map)
+            if keep_dict_ner and isinstance(ner_output_raw, dict):
+                ner_as_json = ner_output_raw
+            else:
+                ner_as_json = convert_yaml_text_to_json(ner_output_raw)
+            search_list_chain_output = reverse_engineer_search_output(url_to_process, field_index)
             search_output_raw = json.dumps(search_list_chain_output)
         else:
-            search_output_raw = "{}" 
+            search_output_raw = "{}"
 
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
+
         return ner_as_json, url_to_process, search_output_raw, current_time, latency
-    
+
     error_message = "Conversational query processed, but no final response was captured."
     current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     return error_message, error_message, error_message, current_time, latency
 
+async def get_api_results_from_conversational_stream_async(query_text, stop_event, run):
+    return await _get_conversation_results_async(query_text, "/invoke", "convo", stop_event, run)
+
+async def get_api_results_from_agent_stream_async(query_text, stop_event, run):
+    return await _get_conversation_results_async(query_text, "/agent/invoke", "agent", stop_event, run, keep_dict_ner=True)
+
+def _decode_event(line):
+    if line.startswith(b"data: "):
+        line = line[6:].strip()
+    if not line:
+        return None
+    try:
+        event = json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    return event if isinstance(event, dict) else None
 
-def get_api_results_from_stream(query_text, stop_event=None):
+def _event_content(event):
+    content = event.get("content")
+    return json.dumps(content) if isinstance(content, (dict, list)) else str(content)
+
+async def _iter_lines(content, max_line_bytes=SSE_MAX_LINE_BYTES):
+    """
+    Splits a response body into lines without aiohttp's readline limit, which
+    raises on lines longer than its read buffer. A line over max_line_bytes is
+    dropped as it streams in, so memory per stream stays bounded; trace events
+    are the usual case, and a dropped line that carried an event marker is logged.
+    """
+    marker_overlap = max(len(marker) for marker in EVENT_MARKERS) - 1
+    buffer = bytearray()
+    dropping, marker_seen, tail = False, False, b""
+    async for chunk in content.iter_chunked(SSE_CHUNK_BYTES):
+        while chunk:
+            newline = chunk.find(b"\n")
+            if newline < 0:
+                piece, chunk = chunk, b""
+            else:
+                piece, chunk = chunk[:newline], chunk[newline + 1:]
+
+            if dropping:
+                scanned = tail + piece
+                marker_seen = marker_seen or any(marker in scanned for marker in EVENT_MARKERS)
+                tail = scanned[-marker_overlap:]
+            else:
+                buffer.extend(piece)
+                if len(buffer) > max_line_bytes:
+                    marker_seen = any(marker in buffer for marker in EVENT_MARKERS)
+                    tail = bytes(buffer[-marker_overlap:])
+                    buffer.clear()
+                    dropping = True
+
+            if newline >= 0:
+                if dropping:
+                    if marker_seen:
+                        logger.warning(f"Dropped an SSE event line over {max_line_bytes} bytes that carried an event marker.")
+                    dropping, marker_seen, tail = False, False, b""
+                else:
+                    yield bytes(buffer)
+                buffer.clear()
+    if buffer and not dropping:
+        yield bytes(buffer)
+
+async def _read_stream_events(response):
+    """
+    Reads the SSE body line by line and keeps only what the comparison needs:
+    the first event's timestamp, the NER and search events, and the final output.
+    Lines are only JSON-decoded when a cheap byte check says they may be one of
+    those events, and reading stops as soon as the final output event arrives.
+    Returns (ner_output, final_output, search_list_chain_output, timestamp).
+    """
+    ner_output, final_output, search_list_chain_output, time_stamp = None, "", None, None
+    seen_first_event = False
+
+    async for line in _iter_lines(response.content):
+        line = line.strip()
+        if not line:
+            continue
+
+        if not seen_first_event:
+            event = _decode_event(line)
+            if event is None:
+                continue
+            seen_first_event = True
+            time_stamp = event.get("timestamp")
+        elif NER_EVENT_MARKER in line or SEARCH_EVENT_MARKER in line or OUTPUT_EVENT_MARKER in line:
+            event = _decode_event(line)
+            if event is None:
+                continue
+        else:
+            continue
+
+        log_title = event.get("log_title")
+        if log_title == "NER Succeded":
+            ner_output = _event_content(event)
+        elif log_title == "Search List Result":
+            search_list_chain_output = _event_content(event)
+        elif log_title is None and "output" in event:
+            final_output = event.get("output", "")
+            break
+
+    return ner_output, final_output, search_list_chain_output, time_stamp
+
+async def get_api_results_from_stream_async(query_text, stop_event, run):
     max_retries = 1
     last_error = "API call returned no error"
     payload = {"query": query_text, "k": 5}
-    for attempt in range(max_retries) : 
+    for attempt in range(max_retries) :
         print(f"attempt : {attempt+1}, for single query : {query_text}")
         start_time = time.time()
         try:
             if stop_event and stop_event.is_set():
                 return "Process stopped externally before starting.", "","", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
-            response = requests.post("https://aitest.ebalina.com/stream", json=payload, stream=True, timeout=50)
-            response.raise_for_status()
+            ner_output, final_output, search_list_chain_output, time_stamp = await _post_stream(payload, run)
 
-            full_response_data = []
-            for line in response.iter_lines():
-                if line:
-                    json_line = line.decode('utf-8').replace('data: ', '').strip()
-                    if json_line:
-                        try:
-                            full_response_data.append(json.loads(json_line))
-                        except json.JSONDecodeError:
-                            pass
-            
-            ner_output, final_output, search_list_chain_output = None, None, None
-
-            if full_response_data : 
-                for item in full_response_data:
-                    if item.get("log_title") == "NER Succeded":
-                        content = item.get("content")
-                        ner_output = json.dumps(content) if isinstance(content, (dict, list)) else str(content)
-                    if item.get("log_title") == "Search List Result":
-                        content = item.get("content")
-                        search_list_chain_output = json.dumps(content) if isinstance(content, (dict, list)) else str(content)
-                if ner_output == None :
-                    continue
-                end_time = time.time()
-                latency = end_time - start_time
-                time_stamp = full_response_data[0].get("timestamp")
-                time_stamp = datetime.datetime.fromtimestamp(time_stamp).strftime("%Y-%m-%d %H:%M:%S")
-                final_output = full_response_data[-1].get("output", "")
-                return ner_output, final_output, search_list_chain_output, time_stamp, latency
-        except requests.exceptions.RequestException as e:
+            if ner_output == None :
+                continue
+            end_time = time.time()
+            latency = end_time - start_time
+            time_stamp = datetime.datetime.fromtimestamp(time_stamp).strftime("%Y-%m-%d %H:%M:%S")
+            return ner_output, final_output, search_list_chain_output, time_stamp, latency
+        except API_ERRORS as e:
             last_error = e
-            time.sleep(1)
+            await asyncio.sleep(1)
 
     error_message = "Retried 5 times but api call returned no results"
     if last_error:
@@ -118,71 +238,3 @@ def get_api_results_from_stream(query_text, stop_event=None):
     current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     return error_message, error_message, error_message, current_time , 0
-
-def get_api_results_from_agent_stream(query_text, stop_event=None):
-    history = []
-    lines = [line.strip() for line in query_text.split('\n') if line.strip()]
-    final_response_data = None
-    
-    inverse_map = create_inverse_field_map(reconstructed_search_mapping)
-    start_time= time.time()
-    max_retries = 1
-    last_error = "API call returned no error"
-
-    if stop_event and stop_event.is_set():
-        return "Process stopped externally before starting.", "","", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
-
-    for i, line in enumerate(lines):
-        if stop_event and stop_event.is_set():
-            error_message = f"Process stopped externally after {i} steps."
-            return error_message, error_message, error_message, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
-        
-        payload = {"query": line, "conversation_history": history, "trace": "false"}
-        for attempt in range(max_retries):
-            print(f"agent attempt : {attempt+1} for line : {line}")
-            try:
-                response = requests.post("https://aitest.ebalina.com/agent/invoke", json=payload, timeout=50)
-                response.raise_for_status()
-                data = response.json()
-                if "ner_output" in data:
-                    history.append({"user": line, "ai": data["ner_output"]})
-                if i == len(lines) - 1:
-                    final_response_data = data
-                break 
-            except requests.exceptions.RequestException as e:
-                last_error = e
-                time.sleep(1) 
-        else:
-            error_message = f"Retried {max_retries} times but API call failed for line: '{line}'."
-            if last_error:
-                error_message += f"\n Error: {last_error}"
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            return error_message, error_message, error_message, current_time, 0
-    end_time = time.time()
-    latency = end_time- start_time
-
-    if final_response_data:
-        ner_output_raw = final_response_data.get("ner_output", "")
-        final_output_raw = final_response_data.get("output", {})
-        search_output_raw = ""
-        ner_as_json = ""
-        
-        url_to_process = final_output_raw.get("url")
-        
-        if url_to_process:
-            if not isinstance(ner_output_raw, dict):
-                ner_as_json = convert_yaml_text_to_json(ner_output_raw)
-            else:
-                ner_as_json = ner_output_raw
-            search_list_chain_output = reverse_engineer_search_output(url_to_process, inverse_map)
-            search_output_raw = json.dumps(search_list_chain_output)
-        else:
-            search_output_raw = "{}" 
-
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        return ner_as_json, url_to_process, search_output_raw, current_time, latency
-    
-    error_message = "Conversational query processed, but no final response was captured."
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    return error_message, error_message, error_message, current_time, latency
@@ -0,0 +1,15 @@
+from helpers import normalize_api_query
+
+
+def test_turn_starting_with_a_number_keeps_it():
+    assert normalize_api_query("hello\n2.5 mg doses") == ("1. hello\n2. 2.5 mg doses", "conversational")
+
+
+def test_sequentially_numbered_turns_are_renumbered():
+    assert normalize_api_query(" 1.a \n\n2.   b") == ("1. a\n2. b", "conversational")
+
+
+def test_out_of_sequence_numbers_are_kept():
+    # Lines not numbered 1., 2., ... may simply start with a number, so the text
+    # is kept as written and only the turn numbers are added in front of it.
+    assert normalize_api_query("2. a\n3. b") == ("1. 2. a\n2. 3. b", "conversational")
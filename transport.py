@@ -0,0 +1,60 @@
+import threading
+import aiohttp
+from engine import MAX_CONCURRENCY
+from settings import get_setting
+
+API_POOL_SIZE = get_setting("API_POOL_SIZE", MAX_CONCURRENCY)
+API_CONNECT_TIMEOUT = get_setting("API_CONNECT_TIMEOUT", 10.0)
+API_READ_TIMEOUT = get_setting("API_READ_TIMEOUT", 50.0)
+API_KEEPALIVE_TIMEOUT = get_setting("API_KEEPALIVE_TIMEOUT", 60.0)
+
+_session = None
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+async def _on_request_start(session, context, params):
+    _count("requests")
+
+async def _on_connection_create_end(session, context, params):
+    _count("new_connections")
+
+async def _on_connection_reuseconn(session, context, params):
+    _count("reused_connections")
+
+async def get_session():
+    """
+    Returns the aiohttp session shared by the /invoke, /stream and /agent/invoke
+    clients. Connections are kept alive and pooled per host, sized to the worker count.
+    Must be called from the engine loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(_on_request_start)
+        trace_config.on_connection_create_end.append(_on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=API_POOL_SIZE,
+            keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+        )
+        timeout = aiohttp.ClientTimeout(total=None, connect=API_CONNECT_TIMEOUT, sock_read=API_READ_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config])
+    return _session
+
+def get_transport_stats():
+    """Returns request and connection reuse counters since the last reset."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["reuse_ratio"] = stats["reused_connections"] / stats["requests"] if stats["requests"] else 0
+    return stats
+
+def reset_transport_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
@@ -0,0 +1,116 @@
+import json
+import queue
+import threading
+import time
+import logging
+import db_utils
+from settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+WRITER_BATCH_SIZE = get_setting("WRITER_BATCH_SIZE", 200)
+WRITER_FLUSH_INTERVAL = get_setting("WRITER_FLUSH_INTERVAL", 1.0)
+WRITER_FAILURE_REPORT_PATH = get_setting("WRITER_FAILURE_REPORT_PATH", "write_failures.jsonl")
+
+_STOP = object()
+
+class WriteBehindWriter:
+    """
+    Background writer for test_results. Workers submit (statement, params) write
+    intents and return straight away. A writer thread collects them and flushes
+    once WRITER_BATCH_SIZE intents are pending or WRITER_FLUSH_INTERVAL seconds have
+    passed. Each flush runs consecutive intents that share a statement as one
+    executemany, so writes are applied in the order they were submitted.
+    Batches that fail are appended to a JSONL failure report so no write is lost
+    silently. close() flushes whatever is still pending.
+    """
+
+    def __init__(self, database_name="llm", batch_size=WRITER_BATCH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL, failure_report_path=WRITER_FAILURE_REPORT_PATH):
+        self.database_name = database_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.failure_report_path = failure_report_path
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, query, params):
+        """Queues one write. After close() the write is executed immediately instead."""
+        with self._lock:
+            self.submitted += 1
+            closed = self._closed
+            if not closed:
+                self._queue.put((query, params))
+        if closed:
+            self._flush([(query, params)])
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush(pending)
+                return
+            if item is not None:
+                if not pending:
+                    deadline = time.time() + self.flush_interval
+                pending.append(item)
+
+            if pending and (len(pending) >= self.batch_size or time.time() >= deadline):
+                self._flush(pending)
+                pending, deadline = [], None
+
+    def _flush(self, intents):
+        # Coalesce only adjacent intents with the same statement. Regrouping across
+        # the batch could apply two writes to the same row out of order.
+        runs = []
+        for query, params in intents:
+            if runs and runs[-1][0] == query:
+                runs[-1][1].append(params)
+            else:
+                runs.append((query, [params]))
+
+        for query, params_list in runs:
+            rowcount = db_utils.execute_many(self.database_name, query, params_list)
+            with self._lock:
+                self.batches += 1
+                if rowcount == -1:
+                    self.failed += len(params_list)
+                else:
+                    self.written += len(params_list)
+            if rowcount == -1:
+                self._report_failure(query, params_list)
+
+    def _report_failure(self, query, params_list):
+        try:
+            with open(self.failure_report_path, "a", encoding="utf-8") as f:
+                for params in params_list:
+                    f.write(json.dumps({"time": time.time(), "query": query, "params": params}, default=str) + "\n")
+            logger.error(f"{len(params_list)} write(s) failed, recorded in '{self.failure_report_path}'.")
+        except Exception as e:
+            logger.error(f"Could not record {len(params_list)} failed write(s). Error: {e}")
+
+    def close(self):
+        """Flushes every pending write and stops the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {"submitted": self.submitted, "written": self.written, "failed": self.failed, "batches": self.batches}